@@ -2,6 +2,7 @@
 # !/usr/bin/env python3
 
 import base64
+import copy
 import subprocess
 import threading
 import time
@@ -10,11 +11,10 @@ import json
 import glob
 import re
 import yaml
-import random
-import string
 import httpx
 import asyncio
-from itertools import chain
+from itertools import chain, product
+from collections import OrderedDict, deque
 from typing import Dict, List, Optional
 import sys
 import requests
@@ -28,10 +28,16 @@ from asyncio import Semaphore
 import ssl
 import logging
 import concurrent.futures
+import multiprocessing
 import statistics
 from geoip2.database import Reader as GeoIPReader
 from playwright.async_api import async_playwright
 import socket
+import sqlite3
+import tempfile
+import hashlib
+import heapq
+import math
 
 ssl._create_default_https_context = ssl._create_unverified_context
 import warnings
@@ -46,15 +52,55 @@ SECONDARY_TEST_URL = "https://www.youtube.com"
 CLASH_API_PORTS = [9090]
 CLASH_API_HOST = "127.0.0.1"
 CLASH_API_SECRET = ""
+CLASH_API_UNIX_SOCKET = ""
+CLASH_API_KEEPALIVE = 30
+CLASH_PID_FILE = "clash.pid"
+CLASH_SHARDS = 1
+CLASH_SHARD_PORT_STEP = 10
+CLASH_READY_TIMEOUT = 30
+VALIDATE_CONFIG = True
+VALIDATE_TIMEOUT = 120
 TIMEOUT = 2.5
 SPEED_TEST = True
-SPEED_TEST_URL = "http://speed.cloudflare.com/__down?bytes=52428800"
+SPEED_TEST_SERVER = "http://speed.cloudflare.com"
+SPEED_TEST_URL = f"{SPEED_TEST_SERVER}/__down?bytes=52428800"
+SPEED_TEST_UPLOAD_URL = f"{SPEED_TEST_SERVER}/__up"
+SPEED_TEST_LATENCY_URL = f"{SPEED_TEST_SERVER}/__down?bytes=0"
+SPEED_TEST_UPLOAD = True
+SPEED_TEST_DIRECT = False
+SPEED_TEST_UPLOAD_SIZE = 10 * 1024 * 1024
+SPEED_TEST_PING_INTERVAL = 0.2
 SPEED_TEST_LIMIT = 968
+SPEED_TEST_STREAMS = 4
+SPEED_TEST_CONCURRENCY = 8
+SPEED_TEST_WARMUP = 2
+SPEED_TEST_DURATION = 8
+SPEED_TEST_SAMPLE_INTERVAL = 0.5
+SPEED_TEST_MIN_SAMPLES = 4
+SPEED_TEST_CONFIDENCE_Z = 2.0
+SPEED_TEST_KEEP_WINDOW = 6
+SPEED_TEST_LISTENER_PORT = 20000
+SPEED_CACHE_FILE = "speed_cache.json"
+SPEED_CACHE_TTL = 24 * 3600
+SPEED_CACHE_FLUSH_INTERVAL = 60
 results_speed = []
 MAX_CONCURRENT_TESTS = 188
 LIMIT = 10000
 CONFIG_FILE = 'clash_config.yaml'
+WRITE_JSON_CONFIG = False
 INPUT = "input"
+SUBSCRIPTION_CACHE_DIR = "sub_cache"
+FETCH_CONCURRENCY = 32
+PER_HOST_CONCURRENCY = 4
+INGEST_QUEUE_SIZE = 32
+PARSE_CACHE_SIZE = 20000
+PARSE_CACHE_FILE = ""
+PARSE_PROCESSES = os.cpu_count() or 1
+PARSE_PROCESS_THRESHOLD = 20000
+PARSE_CHUNK_SIZE = 5000
+GEOIP_BATCH_SIZE = 2048
+BROWSER_POOL_SIZE = 4
+BROWSER_BLOCKED_RESOURCES = {"image", "font", "stylesheet", "media"}
 BAN = ["中国", "China", "CN", "电信", "移动", "联通", "Hong Kong", "Taiwan", "HK", "TW", "澳门", "Macao", "MO","台湾","香港"]
 headers = {
     'Accept-Charset': 'utf-8',
@@ -65,8 +111,25 @@ STABILITY_TESTS = 3
 STABILITY_INTERVAL = 2
 MIN_SUCCESS_RATE = 0.8
 MAX_STD_DEV = 200
+ADAPTIVE_EXTRA_TESTS = 0
+BORDERLINE_STD_DEV_MARGIN = 0.2
+BULK_DELAY_TEST = True
+DELAY_GROUP_CHUNK = 50
+DELAY_GROUP_PREFIX = "延迟测试"
 GEOIP_DB_PATH = "GeoLite2-Country.mmdb"
+DNS_CONCURRENCY = 64
+EXCLUSION_CACHE_FILE = "exclusion_cache.db"
+EXCLUSION_CACHE_TTL = 7 * 24 * 3600
+LATENCY_HISTORY_FILE = "latency_history.db"
+LATENCY_MAX_AGE = 24 * 3600
+LATENCY_HISTORY_TTL = 7 * 24 * 3600
+LATENCY_HISTORY_RUNS = 10
 switch_lock = threading.Lock()
+controller_session = requests.Session()
+controller_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=len(CLASH_API_PORTS), pool_maxsize=4))
+
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+YamlDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
 
 # Setup logging
 logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -152,42 +215,61 @@ clash_config_template = {
     ]
 }
 
+def yaml_load(stream):
+    return yaml.load(stream, Loader=YamlLoader)
+
+def yaml_dump(data, stream=None, **kwargs):
+    return yaml.dump(data, stream, Dumper=YamlDumper, allow_unicode=True, **kwargs)
+
+def write_config(config, yaml_path, sort_keys=True):
+    with open(yaml_path, "w", encoding="utf-8") as f:
+        yaml_dump(config, f, sort_keys=sort_keys, default_flow_style=False)
+    json_path = f'{yaml_path}.json'
+    if WRITE_JSON_CONFIG:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(config, f, ensure_ascii=False)
+    elif os.path.exists(json_path):
+        os.remove(json_path)
+
+def split_link(link):
+    body = link.split('://', 1)[1]
+    body, _, fragment = body.partition('#')
+    return body, urllib.parse.unquote(fragment.strip())
+
+def parse_query(query):
+    params = {}
+    for key, value in urllib.parse.parse_qsl(query):
+        params.setdefault(key, value)
+    return params
+
 def parse_hysteria2_link(link):
-    link = link[14:]
-    parts = link.split('@')
-    uuid = parts[0]
-    server_info = parts[1].split('?')
-    server = server_info[0].split(':')[0]
-    port = int(server_info[0].split(':')[1].split('/')[0].strip())
-    query_params = urllib.parse.parse_qs(server_info[1] if len(server_info) > 1 else '')
-    insecure = '1' in query_params.get('insecure', ['0'])
-    sni = query_params.get('sni', [''])[0]
-    name = urllib.parse.unquote(link.split('#')[-1].strip())
+    body, name = split_link(link)
+    uuid, server_info = body.split('@', 1)
+    host_port, _, query = server_info.partition('?')
+    server, port = host_port.split(':')[:2]
+    params = parse_query(query)
+    insecure = params.get('insecure', '0') == '1'
     return {
-        "name": f"{name}",
+        "name": name,
         "server": server,
-        "port": port,
+        "port": int(port.split('/')[0].strip()),
         "type": "hysteria2",
         "password": uuid,
         "auth": uuid,
-        "sni": sni,
+        "sni": params.get('sni', ''),
         "skip-cert-verify": not insecure,
         "client-fingerprint": "chrome"
     }
 
 def parse_ss_link(link):
-    link = link[5:]
-    if "#" in link:
-        config_part, name = link.split('#')
-    else:
-        config_part, name = link, ""
-    decoded = base64.urlsafe_b64decode(config_part.split('@')[0] + '=' * (-len(config_part.split('@')[0]) % 4)).decode('utf-8')
+    config_part, name = split_link(link)
+    user_info, server_info = config_part.split('@')
+    decoded = base64.urlsafe_b64decode(user_info + '=' * (-len(user_info) % 4)).decode('utf-8')
     method_passwd = decoded.split(':')
     cipher, password = method_passwd if len(method_passwd) == 2 else (method_passwd[0], "")
-    server_info = config_part.split('@')[1]
     server, port = server_info.split(':') if ":" in server_info else (server_info, "")
     return {
-        "name": urllib.parse.unquote(name),
+        "name": name,
         "type": "ss",
         "server": server,
         "port": int(port),
@@ -197,53 +279,55 @@ def parse_ss_link(link):
     }
 
 def parse_trojan_link(link):
-    link = link[9:]
-    config_part, name = link.split('#')
+    config_part, name = split_link(link)
     user_info, host_info = config_part.split('@')
     username, password = user_info.split(':') if ":" in user_info else ("", user_info)
     host, port_and_query = host_info.split(':') if ":" in host_info else (host_info, "")
-    port, query = port_and_query.split('?', 1) if '?' in port_and_query else (port_and_query, "")
+    port, _, query = port_and_query.partition('?')
+    params = parse_query(query)
     return {
-        "name": urllib.parse.unquote(name),
+        "name": name,
         "type": "trojan",
         "server": host,
         "port": int(port),
         "password": password,
-        "sni": urllib.parse.parse_qs(query).get("sni", [""])[0],
-        "skip-cert-verify": urllib.parse.parse_qs(query).get("skip-cert-verify", ["false"])[0] == "true"
+        "sni": params.get("sni", ""),
+        "skip-cert-verify": params.get("skip-cert-verify", "false") == "true"
     }
 
 def parse_vless_link(link):
-    link = link[8:]
-    config_part, name = link.split('#')
-    user_info, host_info = config_part.split('@')
-    uuid = user_info
-    host, query = host_info.split('?', 1) if '?' in host_info else (host_info, "")
+    config_part, name = split_link(link)
+    uuid, host_info = config_part.split('@')
+    host, _, query = host_info.partition('?')
     port = host.split(':')[-1] if ':' in host else ""
     host = host.split(':')[0] if ':' in host else ""
+    params = parse_query(query)
+    security = params.get("security", "none")
+    network = params.get("type", "tcp")
     return {
-        "name": urllib.parse.unquote(name),
+        "name": name,
         "type": "vless",
         "server": host,
         "port": int(port),
         "uuid": uuid,
-        "security": urllib.parse.parse_qs(query).get("security", ["none"])[0],
-        "tls": urllib.parse.parse_qs(query).get("security", ["none"])[0] == "tls",
-        "sni": urllib.parse.parse_qs(query).get("sni", ""),
-        "skip-cert-verify": urllib.parse.parse_qs(query).get("skip-cert-verify", ["false"])[0] == "true",
-        "network": urllib.parse.parse_qs(query).get("type", ["tcp"])[0],
+        "security": security,
+        "tls": security == "tls",
+        "sni": params.get("sni", ""),
+        "skip-cert-verify": params.get("skip-cert-verify", "false") == "true",
+        "network": network,
         "ws-opts": {
-            "path": urllib.parse.parse_qs(query).get("path", [""])[0],
+            "path": params.get("path", ""),
             "headers": {
-                "Host": urllib.parse.parse_qs(query).get("host", [""])[0]
+                "Host": params.get("host", "")
             }
-        } if urllib.parse.parse_qs(query).get("type", ["tcp"])[0] == "ws" else {}
+        } if network == "ws" else {}
     }
 
 def parse_vmess_link(link):
-    link = link[8:]
+    link = link.split('://', 1)[1]
     decoded_link = base64.urlsafe_b64decode(link + '=' * (-len(link) % 4)).decode("utf-8")
     vmess_info = json.loads(decoded_link)
+    network = vmess_info.get("net", "tcp")
     return {
         "name": urllib.parse.unquote(vmess_info.get("ps", "vmess")),
         "type": "vmess",
@@ -252,7 +336,7 @@ def parse_vmess_link(link):
         "uuid": vmess_info["id"],
         "alterId": int(vmess_info.get("aid", 0)),
         "cipher": "auto",
-        "network": vmess_info.get("net", "tcp"),
+        "network": network,
         "tls": vmess_info.get("tls", "") == "tls",
         "sni": vmess_info.get("sni", ""),
         "ws-opts": {
@@ -260,48 +344,191 @@ def parse_vmess_link(link):
             "headers": {
                 "Host": vmess_info.get("host", "")
             }
-        } if vmess_info.get("net", "tcp") == "ws" else {}
+        } if network == "ws" else {}
     }
 
-def parse_ss_sub(link):
-    new_links = []
+LINK_PARSERS = {
+    "hysteria2": parse_hysteria2_link,
+    "hy2": parse_hysteria2_link,
+    "trojan": parse_trojan_link,
+    "ss": parse_ss_link,
+    "vless": parse_vless_link,
+    "vmess": parse_vmess_link,
+}
+SUPPORTED_SCHEMES = tuple(f"{scheme}://" for scheme in LINK_PARSERS)
+
+async def parse_ss_sub(link, fetcher):
     try:
-        response = requests.get(link, headers=headers, verify=False, allow_redirects=True)
-        if response.status_code == 200:
-            data = response.json()
-            new_links = [{"name": x['remarks'], "type": "ss", "server": x['server'], "port": x['server_port'],
-                          "cipher": x['method'], "password": x['password'], "udp": True} for x in data]
-            return new_links
-    except requests.RequestException as e:
-        logging.error(f"请求错误: {e}")
+        content, cached = await fetcher.fetch(link)
+        if cached is not None:
+            return cached
+        data = json.loads(content)
+        new_links = [{"name": x['remarks'], "type": "ss", "server": x['server'], "port": x['server_port'],
+                      "cipher": x['method'], "password": x['password'], "udp": True} for x in data]
+        fetcher.remember(link, new_links)
         return new_links
+    except (httpx.HTTPError, ValueError, KeyError, TypeError) as e:
+        logging.error(f"请求错误: {e}")
+        return []
 
-def parse_md_link(link):
+async def parse_md_link(link, fetcher):
     try:
-        response = requests.get(link)
-        response.raise_for_status()
-        content = response.text
+        content, cached = await fetcher.fetch(link)
+        if cached is not None:
+            return cached
         content = urllib.parse.unquote(content)
         pattern = r'(?:vless|vmess|trojan|hysteria2|ss):\/\/[^#\s]*(?:#[^\s]*)?'
         matches = re.findall(pattern, content)
+        fetcher.remember(link, matches)
         return matches
-    except requests.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"请求错误: {e}")
         return []
 
-async def js_render(url):
-    async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True, args=['--no-sandbox', '--disable-dev-shm-usage'])
-        page = await browser.new_page()
+class SubscriptionFetcher:
+    def __init__(self, cache_dir=SUBSCRIPTION_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, "index.json")
+        limits = httpx.Limits(max_connections=FETCH_CONCURRENCY, max_keepalive_connections=FETCH_CONCURRENCY)
+        self.client = httpx.AsyncClient(verify=False, follow_redirects=True, headers=headers, timeout=TIMEOUT, limits=limits)
+        self.host_semaphores = {}
+        self.pending = {}
+        self.fetched = set()
+        self.index = {}
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                self.index = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def _result_file(self, url):
+        return os.path.join(self.cache_dir, f"{hashlib.sha1(url.encode('utf-8')).hexdigest()}.json")
+
+    def _load_result(self, url):
+        try:
+            with open(self._result_file(url), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    async def fetch(self, url):
+        self.fetched.add(url)
+        host = urllib.parse.urlsplit(url).hostname or ""
+        semaphore = self.host_semaphores.setdefault(host, Semaphore(PER_HOST_CONCURRENCY))
+        entry = self.index.get(url, {})
+        conditional = {}
+        if entry.get("etag"):
+            conditional["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            conditional["If-Modified-Since"] = entry["last_modified"]
+        async with semaphore:
+            response = await self.client.get(url, headers=conditional)
+            if response.status_code == 304:
+                cached = self._load_result(url)
+                if cached is not None:
+                    logging.info(f"订阅 {url} 未变化 (304)，使用缓存解析结果")
+                    return None, cached
+                response = await self.client.get(url)
+            response.raise_for_status()
+        digest = hashlib.sha256(response.content).hexdigest()
+        meta = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"), "hash": digest}
+        if entry.get("hash") == digest:
+            cached = self._load_result(url)
+            if cached is not None:
+                logging.info(f"订阅 {url} 内容未变化，使用缓存解析结果")
+                self.index[url] = meta
+                return response.text, cached
+        self.pending[url] = meta
+        return response.text, None
+
+    def remember(self, url, result):
+        meta = self.pending.pop(url, None)
+        if meta is None:
+            return
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._result_file(url), 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False)
+            self.index[url] = meta
+        except Exception as e:
+            logging.warning(f"写入订阅缓存失败: {e}")
+
+    def prune(self):
+        self.index = {url: meta for url, meta in self.index.items() if url in self.fetched}
+        keep = {os.path.basename(self._result_file(url)) for url in self.index}
+        keep.add(os.path.basename(self.index_file))
+        removed = 0
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.json') and filename not in keep:
+                os.remove(os.path.join(self.cache_dir, filename))
+                removed += 1
+        if removed:
+            logging.info(f"已清理 {removed} 个本次未使用的订阅缓存")
+
+    async def close(self):
+        await self.client.aclose()
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self.prune()
+            tmp_file = f"{self.index_file}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.index, f, ensure_ascii=False)
+            os.replace(tmp_file, self.index_file)
+        except Exception as e:
+            logging.error(f"保存订阅缓存索引失败: {e}")
+
+class BrowserPool:
+    def __init__(self, size=BROWSER_POOL_SIZE):
+        self.semaphore = Semaphore(size)
+        self.lock = asyncio.Lock()
+        self.playwright = None
+        self.browser = None
+
+    async def _get_browser(self):
+        async with self.lock:
+            if self.browser is None:
+                self.playwright = await async_playwright().start()
+                self.browser = await self.playwright.chromium.launch(headless=True, args=['--no-sandbox', '--disable-dev-shm-usage'])
+                logging.info("已启动共享 Playwright 浏览器")
+            return self.browser
+
+    @staticmethod
+    async def _block_resources(route):
+        if route.request.resource_type in BROWSER_BLOCKED_RESOURCES:
+            await route.abort()
+        else:
+            await route.continue_()
+
+    async def render(self, url):
+        async with self.semaphore:
+            context = None
+            try:
+                browser = await self._get_browser()
+                context = await browser.new_context()
+                await context.route("**/*", self._block_resources)
+                page = await context.new_page()
+                await page.goto(url, timeout=4000)
+                return await page.content()
+            except Exception as e:
+                logging.error(f"Playwright 渲染失败: {e}")
+                return ""
+            finally:
+                if context is not None:
+                    await context.close()
+
+    async def close(self):
         try:
-            await page.goto(url, timeout=4000)
-            content = await page.content()
-            await browser.close()
-            return content
+            if self.browser is not None:
+                await self.browser.close()
+            if self.playwright is not None:
+                await self.playwright.stop()
         except Exception as e:
-            logging.error(f"Playwright 渲染失败: {e}")
-            await browser.close()
-            return ""
+            logging.warning(f"关闭 Playwright 浏览器失败: {e}")
+        self.browser = None
+        self.playwright = None
+
+async def js_render(url, browser_pool):
+    return await browser_pool.render(url)
 
 def match_nodes(text):
     proxy_pattern = r"\{[^}]*name\s*:\s*['\"][^'\"]+['\"][^}]*server\s*:\s*[^,]+[^}]*\}"
@@ -309,108 +536,294 @@ def match_nodes(text):
     proxies_list = []
     for node in nodes:
         try:
-            node_dict = yaml.safe_load(node)
+            node_dict = yaml_load(node)
             proxies_list.append(node_dict)
         except yaml.YAMLError as e:
             logging.warning(f"无法解析代理节点: {e} - 内容: {node[:50]}...")
     yaml_data = {"proxies": proxies_list}
     return yaml_data
 
-async def process_url(url):
+async def decode_subscription(url, content, browser_pool):
     isyaml = False
-    new_links = []
-    try:
-        async with httpx.AsyncClient(verify=False, follow_redirects=True, headers=headers, timeout=TIMEOUT) as client:
-            response = await client.get(url)
-            response.raise_for_status()
-            content = response.text
-            logging.info(f"成功从 {url} 获取内容")
-            
-            if 'proxies:' in content:
-                if '</pre>' in content:
-                    content = content.replace('<pre style="word-wrap: break-word; white-space: pre-wrap;">', '').replace('</pre>', '')
-                yaml_data = yaml.safe_load(content)
+    if 'proxies:' in content:
+        if '</pre>' in content:
+            content = content.replace('<pre style="word-wrap: break-word; white-space: pre-wrap;">', '').replace('</pre>', '')
+        yaml_data = yaml_load(content)
+        if 'proxies' in yaml_data:
+            isyaml = True
+            return yaml_data['proxies'] if yaml_data['proxies'] else [], isyaml
+    else:
+        try:
+            decoded_bytes = base64.b64decode(content)
+            decoded_content = decoded_bytes.decode('utf-8')
+            decoded_content = urllib.parse.unquote(decoded_content)
+            return decoded_content.splitlines(), isyaml
+        except Exception as e:
+            logging.warning(f"内容无法解码，尝试 Playwright 渲染: {e}")
+            content = await js_render(url, browser_pool)
+            if 'external-controller' in content:
+                try:
+                    yaml_data = yaml_load(content)
+                except:
+                    yaml_data = match_nodes(content)
                 if 'proxies' in yaml_data:
                     isyaml = True
-                    return yaml_data['proxies'] if yaml_data['proxies'] else [], isyaml
+                    return yaml_data['proxies'], isyaml
             else:
-                try:
-                    decoded_bytes = base64.b64decode(content)
-                    decoded_content = decoded_bytes.decode('utf-8')
-                    decoded_content = urllib.parse.unquote(decoded_content)
-                    return decoded_content.splitlines(), isyaml
-                except Exception as e:
-                    logging.warning(f"内容无法解码，尝试 Playwright 渲染: {e}")
-                    content = await js_render(url)
-                    if 'external-controller' in content:
-                        try:
-                            yaml_data = yaml.safe_load(content)
-                        except:
-                            yaml_data = match_nodes(content)
-                        if 'proxies' in yaml_data:
-                            isyaml = True
-                            return yaml_data['proxies'], isyaml
-                    else:
-                        pattern = r'([A-Za-z0-9_+/\-]+={0,2})'
-                        matches = re.findall(pattern, content)
-                        stdout = matches[-1] if matches else []
-                        decoded_bytes = base64.b64decode(stdout)
-                        decoded_content = decoded_bytes.decode('utf-8')
-                        return decoded_content.splitlines(), isyaml
+                pattern = r'([A-Za-z0-9_+/\-]+={0,2})'
+                matches = re.findall(pattern, content)
+                stdout = matches[-1] if matches else []
+                decoded_bytes = base64.b64decode(stdout)
+                decoded_content = decoded_bytes.decode('utf-8')
+                return decoded_content.splitlines(), isyaml
+    return [], isyaml
+
+async def process_url(url, fetcher, browser_pool, parse_links):
+    try:
+        content, cached = await fetcher.fetch(url)
+        if cached is not None:
+            new_links, isyaml = cached
+        else:
+            logging.info(f"成功从 {url} 获取内容")
+            new_links, isyaml = await decode_subscription(url, content, browser_pool)
+        if not isyaml:
+            new_links = await parse_links(new_links)
+        fetcher.remember(url, [new_links, True])
+        return new_links, True
     except httpx.RequestError as e:
         logging.error(f"请求 {url} 时发生错误: {e}")
     except Exception as e:
         logging.error(f"处理 {url} 时发生意外错误: {e}")
-    return [], isyaml
+    return [], False
 
-def parse_proxy_link(link):
+_parse_cache = OrderedDict()
+
+def _copy_node(node):
+    return {k: _copy_node(v) if isinstance(v, dict) else v for k, v in node.items()}
+
+def _parse_proxy_link(link):
+    parser = LINK_PARSERS.get(link.partition('://')[0])
+    if parser is None:
+        return None
     try:
-        if link.startswith(("hysteria2://", "hy2://")):
-            return parse_hysteria2_link(link)
-        elif link.startswith("trojan://"):
-            return parse_trojan_link(link)
-        elif link.startswith("ss://"):
-            return parse_ss_link(link)
-        elif link.startswith("vless://"):
-            return parse_vless_link(link)
-        elif link.startswith("vmess://"):
-            return parse_vmess_link(link)
+        return parser(link)
     except Exception as e:
         logging.warning(f"解析代理链接 {link[:50]}... 失败: {e}")
         return None
 
-def deduplicate_proxies(proxies_list):
-    unique_proxies = []
-    seen = set()
-    for proxy in proxies_list:
-        key_tuple = (proxy.get('server'), proxy.get('port'), proxy.get('type'))
-        if proxy.get('password'):
-            key_tuple += (proxy['password'],)
-        if key_tuple not in seen:
-            seen.add(key_tuple)
-            unique_proxies.append(proxy)
-    return unique_proxies
-
-def add_random_suffix(name, existing_names):
-    suffix = ''.join(random.choices(string.ascii_letters + string.digits, k=4))
-    new_name = f"{name}-{suffix}"
-    while new_name in existing_names:
-        suffix = ''.join(random.choices(string.ascii_letters + string.digits, k=4))
-        new_name = f"{name}-{suffix}"
-    return new_name
+def _remember_parse(link, node):
+    _parse_cache[link] = node
+    if len(_parse_cache) > PARSE_CACHE_SIZE:
+        _parse_cache.popitem(last=False)
+
+def parse_proxy_link(link):
+    if link in _parse_cache:
+        _parse_cache.move_to_end(link)
+        node = _parse_cache[link]
+    else:
+        node = _parse_proxy_link(link)
+        _remember_parse(link, node)
+    return _copy_node(node) if node else None
+
+def parse_link_chunk(links):
+    return [_parse_proxy_link(link) for link in links]
+
+async def parse_links_in_processes(new_links, executor):
+    links = [link for link in new_links if link.startswith(SUPPORTED_SCHEMES)]
+    if len(links) < len(new_links):
+        logging.warning(f"跳过 {len(new_links) - len(links)} 条无效或不支持的链接")
+    pending = list(dict.fromkeys(link for link in links if link not in _parse_cache))
+    chunks = [pending[i:i + PARSE_CHUNK_SIZE] for i in range(0, len(pending), PARSE_CHUNK_SIZE)]
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(loop.run_in_executor(executor, parse_link_chunk, chunk) for chunk in chunks))
+    parsed = {}
+    for chunk, nodes in zip(chunks, results):
+        for link, node in zip(chunk, nodes):
+            parsed[link] = node
+            _remember_parse(link, node)
+    logging.info(f"多进程解析 {len(pending)} 条链接 ({len(chunks)} 个分块)")
+    for link in links:
+        if link in parsed:
+            node = _copy_node(parsed[link]) if parsed[link] else None
+        else:
+            node = parse_proxy_link(link)
+        if node:
+            yield node
+
+def load_parse_cache(cache_file=PARSE_CACHE_FILE):
+    if not cache_file or not os.path.exists(cache_file):
+        return
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            _parse_cache.update(json.load(f))
+        logging.info(f"已加载 {len(_parse_cache)} 条链接解析缓存")
+    except Exception as e:
+        logging.warning(f"加载链接解析缓存失败: {e}")
+
+def save_parse_cache(cache_file=PARSE_CACHE_FILE):
+    if not cache_file:
+        return
+    tmp_file = f"{cache_file}.tmp"
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(_parse_cache, f, ensure_ascii=False)
+        os.replace(tmp_file, cache_file)
+    except Exception as e:
+        logging.error(f"保存链接解析缓存失败: {e}")
+
+LEGACY_QUERY_LOOKUPS = {
+    "vless": ("security", "security", "sni", "skip-cert-verify", "type", "path", "host", "type"),
+    "trojan": ("sni", "skip-cert-verify"),
+    "hysteria2": ("insecure", "sni"),
+}
+
+def benchmark_link_parsers(path="sc/sc.txt", rounds=3):
+    links = []
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            links = [line.strip() for line in f if line.strip().startswith(SUPPORTED_SCHEMES)]
+    if not links:
+        ss_user = base64.urlsafe_b64encode(b'aes-256-gcm:password').decode().rstrip('=')
+        for i in range(2000):
+            vmess = base64.b64encode(json.dumps({"ps": f"vmess-{i}", "add": f"v{i}.example.com", "port": 443, "id": f"uuid-{i}",
+                                                 "aid": 0, "net": "ws", "path": "/ws", "host": "cdn.example.com", "tls": "tls"}).encode()).decode()
+            links.extend([
+                f"vless://uuid-{i}@vl{i}.example.com:443?security=tls&sni=sni{i}.example.com&type=ws&path=%2Fws&host=h{i}.example.com#vless-{i}",
+                f"trojan://password{i}@tr{i}.example.com:443?sni=tr{i}.example.com&skip-cert-verify=true#trojan-{i}",
+                f"ss://{ss_user}@10.0.{i // 250}.{i % 250}:8388#ss-{i}",
+                f"hysteria2://auth{i}@hy{i}.example.com:443/?insecure=1&sni=hy{i}.example.com#hy2-{i}",
+                f"vmess://{vmess}",
+            ])
+        logging.warning(f"{path} 中没有可用链接，使用 {len(links)} 条合成链接进行基准测试")
+    corpus = links * rounds
+    queries = [(link.split('://', 1)[0], link.partition('#')[0].partition('?')[2]) for link in corpus]
+    start = time.perf_counter()
+    for scheme, query in queries:
+        for key in LEGACY_QUERY_LOOKUPS.get(scheme, ()):
+            urllib.parse.parse_qs(query).get(key)
+    legacy_query = time.perf_counter() - start
+    start = time.perf_counter()
+    for scheme, query in queries:
+        params = parse_query(query)
+        for key in LEGACY_QUERY_LOOKUPS.get(scheme, ()):
+            params.get(key)
+    single_query = time.perf_counter() - start
+    start = time.perf_counter()
+    for link in corpus:
+        _parse_proxy_link(link)
+    uncached = time.perf_counter() - start
+    _parse_cache.clear()
+    start = time.perf_counter()
+    for link in corpus:
+        parse_proxy_link(link)
+    cached = time.perf_counter() - start
+    print(f"链接数: {len(links)} x {rounds} 轮")
+    print(f"查询参数: 逐字段 parse_qs {len(corpus) / legacy_query:.0f} 条/秒, 单次 parse_query {len(corpus) / single_query:.0f} 条/秒")
+    print(f"无缓存解析: {len(corpus) / uncached:.0f} 条/秒")
+    print(f"LRU 缓存解析: {len(corpus) / cached:.0f} 条/秒 (命中率 {1 - len(links) / len(corpus):.0%})")
+
+def benchmark_yaml(paths=None, rounds=5):
+    paths = paths or sorted(glob.glob(os.path.join('sc', '*.yaml'))) + ['fast-filtered.yaml']
+    loaders = [("SafeLoader", yaml.SafeLoader), ("CSafeLoader", getattr(yaml, 'CSafeLoader', None))]
+    dumpers = [("SafeDumper", yaml.SafeDumper), ("CSafeDumper", getattr(yaml, 'CSafeDumper', None))]
+    print(f"libyaml 可用: {yaml.__with_libyaml__}")
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        timings = []
+        data = None
+        for name, loader in loaders:
+            if loader is None:
+                continue
+            start = time.perf_counter()
+            for _ in range(rounds):
+                data = yaml.load(text, Loader=loader)
+            timings.append(f"{name} {(time.perf_counter() - start) / rounds * 1000:.1f}ms")
+        for name, dumper in dumpers:
+            if dumper is None:
+                continue
+            start = time.perf_counter()
+            for _ in range(rounds):
+                yaml.dump(data, Dumper=dumper, allow_unicode=True, default_flow_style=False)
+            timings.append(f"{name} {(time.perf_counter() - start) / rounds * 1000:.1f}ms")
+        start = time.perf_counter()
+        for _ in range(rounds):
+            json.dumps(data, ensure_ascii=False, default=str)
+        timings.append(f"json.dumps {(time.perf_counter() - start) / rounds * 1000:.1f}ms")
+        print(f"{path} ({len(text) // 1024}KB): " + ", ".join(timings))
+
+FINGERPRINT_FIELDS = {
+    "ss": ("cipher", "password", "plugin", "plugin-opts"),
+    "ssr": ("cipher", "password", "protocol", "protocol-param", "obfs", "obfs-param"),
+    "trojan": ("password", "network", "sni", "ws-opts", "grpc-opts"),
+    "vless": ("uuid", "flow", "network", "tls", "sni", "servername", "ws-opts", "grpc-opts", "h2-opts", "reality-opts"),
+    "vmess": ("uuid", "alterId", "network", "tls", "sni", "servername", "ws-opts", "grpc-opts", "h2-opts"),
+    "hysteria2": ("password", "auth", "sni", "obfs", "obfs-password"),
+    "tuic": ("uuid", "password", "sni", "alpn"),
+}
+FINGERPRINT_HOST_KEYS = {"server", "sni", "servername", "host"}
+
+def _canonical_value(key, value):
+    if isinstance(value, dict):
+        items = {str(k).lower(): _canonical_value(str(k).lower(), v) for k, v in value.items()}
+        return {k: v for k, v in sorted(items.items()) if v not in (None, "", [], {})}
+    if isinstance(value, (list, tuple)):
+        values = [_canonical_value(key, v) for v in value]
+        return values[0] if len(values) == 1 else values
+    if isinstance(value, str):
+        value = value.strip()
+        return value.lower().rstrip('.') if key in FINGERPRINT_HOST_KEYS else value
+    return value
+
+def node_fingerprint(node):
+    node_type = str(node.get("type", "")).lower()
+    node_type = "hysteria2" if node_type == "hy2" else node_type
+    fields = FINGERPRINT_FIELDS.get(node_type)
+    if fields is None:
+        fields = sorted(k for k in node if k not in ("name", "server", "port", "type"))
+    try:
+        port = int(node.get("port"))
+    except (TypeError, ValueError):
+        port = node.get("port")
+    canonical = [node_type, _canonical_value("server", node.get("server")), port]
+    canonical.extend((field, _canonical_value(field, node.get(field))) for field in fields
+                     if node.get(field) is not False and node.get(field) not in (None, "", [], {}))
+    return json.dumps(canonical, ensure_ascii=False, sort_keys=True, default=str)
+
+def node_id(node):
+    return hashlib.sha256(node_fingerprint(node).encode('utf-8')).hexdigest()[:16]
+
+def assign_unique_names(nodes):
+    taken = set()
+    duplicates = []
+    for node in nodes:
+        name = node["name"] = str(node.get("name", "unnamed-node"))
+        if name in taken:
+            duplicates.append(node)
+        else:
+            taken.add(name)
+    for node in duplicates:
+        suffix = node_id(node)[:4]
+        new_name = f"{node['name']}-{suffix}"
+        counter = 1
+        while new_name in taken:
+            new_name = f"{node['name']}-{suffix}{counter}"
+            counter += 1
+        taken.add(new_name)
+        node["name"] = new_name
+    return nodes
 
 def read_txt_files(folder_path):
-    all_lines = []
     if not os.path.isdir(folder_path):
-        return all_lines
+        return
     txt_files = glob.glob(os.path.join(folder_path, '*.txt'))
     for file_path in txt_files:
+        logging.info(f'加载【{file_path}】中节点')
         with open(file_path, 'r', encoding='utf-8') as file:
-            lines = file.readlines()
-            all_lines.extend(line.strip() for line in lines)
-    if all_lines:
-        logging.info(f'加载【{folder_path}】目录下所有txt中节点')
-    return all_lines
+            for line in file:
+                yield line.strip()
 
 def read_yaml_files(folder_path):
     load_nodes = []
@@ -421,7 +834,7 @@ def read_yaml_files(folder_path):
     for file_path in yaml_files:
         try:
             with open(file_path, 'r', encoding='utf-8') as file:
-                config = yaml.safe_load(file)
+                config = yaml_load(file)
                 if config and 'proxies' in config:
                     load_nodes.extend(config['proxies'])
         except Exception as e:
@@ -434,167 +847,335 @@ def filter_by_types_alt(allowed_types, nodes):
     return [x for x in nodes if x.get('type') in allowed_types]
 
 def merge_lists(*lists):
-    return [item for item in chain.from_iterable(lists) if item != '']
+    return (item for item in chain.from_iterable(lists) if item != '')
 
-async def handle_links(new_links, resolve_name_conflicts, cache):
-    tasks = []
+def handle_links(new_links):
     for new_link in new_links:
-        if new_link.startswith(("hysteria2://", "hy2://", "trojan://", "ss://", "vless://", "vmess://")):
+        if new_link.startswith(SUPPORTED_SCHEMES):
             node = parse_proxy_link(new_link)
             if node:
-                resolve_name_conflicts(node, cache)
+                yield node
         else:
             logging.warning(f"跳过无效或不支持的链接: {new_link}")
-    await asyncio.gather(*tasks)
+
+async def fetch_source(coro, isyaml):
+    return await coro, isyaml
 
 async def generate_clash_config(links, load_nodes):
     now = datetime.now()
     logging.info(f"当前时间: {now}\n---")
     final_nodes = []
-    existing_names = set()
-    config = clash_config_template.copy()
+    config = copy.deepcopy(clash_config_template)
     cache = ExclusionCache()
+    geoip = GeoIPFilter()
+    fetcher = SubscriptionFetcher()
+    browser_pool = BrowserPool()
+    source_queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    node_queue = asyncio.Queue(maxsize=GEOIP_BATCH_SIZE * 2)
+    if CLASH_API_UNIX_SOCKET:
+        config["external-controller-unix"] = CLASH_API_UNIX_SOCKET
+    load_parse_cache()
+
+    async def fetch_sources():
+        try:
+            for link in links:
+                link = link.strip()
+                if not link:
+                    continue
+                if link.startswith(SUPPORTED_SCHEMES):
+                    await source_queue.put(([link], False))
+                    continue
+                elif '|links' in link or '.md' in link:
+                    link = link.replace('|links', '')
+                    task = fetch_source(parse_md_link(link, fetcher), isyaml=False)
+                elif '|ss' in link:
+                    link = link.replace('|ss', '')
+                    task = fetch_source(parse_ss_sub(link, fetcher), isyaml=True)
+                else:
+                    logging.info(f'当前正在处理link: {link}')
+                    if '{' in link:
+                        try:
+                            link = resolve_template_url(link)
+                        except Exception as e:
+                            logging.error(f"解析模板URL失败: {e}")
+                            continue
+                    task = process_url(link, fetcher, browser_pool, parse_links)
+                await source_queue.put(asyncio.create_task(task))
+        finally:
+            await source_queue.put(None)
+
+    parse_executor = None
+
+    def get_parse_executor():
+        nonlocal parse_executor
+        if parse_executor is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            parse_executor = concurrent.futures.ProcessPoolExecutor(max_workers=PARSE_PROCESSES,
+                                                                    mp_context=multiprocessing.get_context(start_method))
+        return parse_executor
+
+    async def parse_links(new_links):
+        if PARSE_PROCESSES > 1 and len(new_links) >= PARSE_PROCESS_THRESHOLD:
+            return [node async for node in parse_links_in_processes(new_links, get_parse_executor())]
+        return list(handle_links(new_links))
+
+    async def parse_sources():
+        seen = set()
+
+        async def emit(node):
+            if any(k in str(node.get("name", "")) for k in BAN):
+                return
+            fingerprint = node_fingerprint(node)
+            if fingerprint not in seen:
+                seen.add(fingerprint)
+                await node_queue.put(node)
 
-    def resolve_name_conflicts(node, cache):
-        server = node.get("server")
-        name = str(node.get("name", "unnamed-node"))
-        if not_contains(name, server, cache):
-            if name in existing_names:
-                name = add_random_suffix(name, existing_names)
-            existing_names.add(name)
-            node["name"] = name
-            final_nodes.append(node)
-
-    for node in load_nodes:
-        resolve_name_conflicts(node, cache)
-
-    tasks = []
-    for link in links:
-        link = link.strip()
-        if not link:
-            continue
-        if link.startswith(("hysteria2://", "hy2://", "trojan://", "ss://", "vless://", "vmess://")):
-            node = parse_proxy_link(link)
-            if node:
-                resolve_name_conflicts(node, cache)
-        elif '|links' in link or '.md' in link:
-            link = link.replace('|links', '')
-            new_links = parse_md_link(link)
-            handle_links(new_links, resolve_name_conflicts, cache)
-        elif '|ss' in link:
-            link = link.replace('|ss', '')
-            new_links = parse_ss_sub(link)
-            for node in new_links:
-                resolve_name_conflicts(node, cache)
-        else:
-            logging.info(f'当前正在处理link: {link}')
-            if '{' in link:
+        try:
+            for node in load_nodes:
+                await emit(node)
+            while (source := await source_queue.get()) is not None:
                 try:
-                    link = resolve_template_url(link)
+                    new_links, isyaml = await source if isinstance(source, asyncio.Task) else source
                 except Exception as e:
-                    logging.error(f"解析模板URL失败: {e}")
+                    logging.error(f"获取订阅链接时出错: {e}")
+                    continue
+                for node in new_links if isyaml else await parse_links(new_links):
+                    await emit(node)
+        finally:
+            await node_queue.put(None)
+
+    async def resolve_nodes():
+        batch = []
+        while True:
+            node = await node_queue.get()
+            if node is not None:
+                batch.append(node)
+                if len(batch) < GEOIP_BATCH_SIZE:
                     continue
-            tasks.append(process_url(link))
+            await geoip.resolve_all(n.get("server") for n in batch)
+            for n in batch:
+                name = str(n.get("name", "unnamed-node"))
+                if not_contains(name, n.get("server"), cache, geoip, key=node_id(n)):
+                    final_nodes.append(n)
+            batch = []
+            if node is None:
+                break
 
-    all_fetched_links = await asyncio.gather(*tasks, return_exceptions=True)
-    
-    for result in all_fetched_links:
-        if isinstance(result, Exception):
-            logging.error(f"获取订阅链接时出错: {result}")
-            continue
-        new_links, isyaml = result
-        if isyaml:
-            for node in new_links:
-                resolve_name_conflicts(node, cache)
-        else:
-            await handle_links(new_links, resolve_name_conflicts, cache)
-
-    final_nodes = deduplicate_proxies(final_nodes)
-    config["proxy-groups"][1]["proxies"] = []
-    for node in final_nodes:
-        name = str(node["name"])
-        if not_contains(name, node["server"], cache):
-            config["proxy-groups"][1]["proxies"].append(name)
-            proxies = list(set(config["proxy-groups"][1]["proxies"]))
-            config["proxy-groups"][1]["proxies"] = proxies
-            config["proxy-groups"][2]["proxies"] = proxies
-            config["proxy-groups"][3]["proxies"] = proxies
+    try:
+        await asyncio.gather(fetch_sources(), parse_sources(), resolve_nodes())
+    finally:
+        await fetcher.close()
+        await browser_pool.close()
+        if parse_executor is not None:
+            parse_executor.shutdown()
+
+    assign_unique_names(final_nodes)
+    proxy_names = [node["name"] for node in final_nodes]
+    for group in config["proxy-groups"][1:]:
+        group["proxies"] = list(proxy_names)
     config["proxies"] = final_nodes
 
     if config["proxies"]:
         global CONFIG_FILE
         CONFIG_FILE = CONFIG_FILE[:-5] if CONFIG_FILE.endswith('.json') else CONFIG_FILE
         try:
-            with open(CONFIG_FILE, "w", encoding="utf-8") as f:
-                yaml.dump(config, f, allow_unicode=True, default_flow_style=False)
-            with open(f'{CONFIG_FILE}.json', "w", encoding="utf-8") as f:
-                json.dump(config, f, ensure_ascii=False)
-            logging.info(f"已经生成Clash配置文件{CONFIG_FILE}|{CONFIG_FILE}.json")
+            write_config(config, CONFIG_FILE)
+            logging.info(f"已经生成Clash配置文件{CONFIG_FILE}" + (f"|{CONFIG_FILE}.json" if WRITE_JSON_CONFIG else ""))
         except Exception as e:
             logging.error(f"保存配置文件失败: {e}")
     else:
         logging.warning('没有节点数据更新')
+    geoip.close()
+    save_parse_cache()
+    _parse_cache.clear()
     cache.save()
+    cache.close()
 
-def not_contains(name, server=None, cache=None):
+class GeoIPFilter:
+    def __init__(self, db_path=GEOIP_DB_PATH, concurrency=DNS_CONCURRENCY):
+        self.reader = None
+        if os.path.exists(db_path):
+            try:
+                self.reader = GeoIPReader(db_path)
+            except Exception as e:
+                logging.error(f"打开 GeoIP 数据库失败: {e}")
+        self.executor = ThreadPoolExecutor(max_workers=concurrency)
+        self.addresses = {}
+        self.countries = {}
+
+    @staticmethod
+    def _gethostbyname(host):
+        try:
+            return socket.gethostbyname(host)
+        except (socket.gaierror, UnicodeError, ValueError) as e:
+            logging.debug(f"无法解析域名 {host}: {e}")
+            return None
+
+    async def resolve_all(self, hosts):
+        if not self.reader:
+            return
+        pending = list({h for h in hosts if isinstance(h, str) and h and h not in self.addresses})
+        if not pending:
+            return
+        loop = asyncio.get_running_loop()
+        addresses = await asyncio.gather(*(loop.run_in_executor(self.executor, self._gethostbyname, h) for h in pending))
+        self.addresses.update(zip(pending, addresses))
+        logging.info(f"已并发解析 {len(pending)} 个节点域名")
+
+    def country(self, server):
+        if not self.reader or not server:
+            return None
+        if server not in self.addresses:
+            self.addresses[server] = self._gethostbyname(server)
+        ip_address = self.addresses[server]
+        if not ip_address:
+            return None
+        if ip_address not in self.countries:
+            try:
+                self.countries[ip_address] = self.reader.country(ip_address).country.iso_code
+            except Exception as e:
+                logging.debug(f"GeoIP 查询 {ip_address} 失败: {e}")
+                self.countries[ip_address] = None
+        return self.countries[ip_address]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        if self.reader:
+            self.reader.close()
+            self.reader = None
+
+def not_contains(name, server, cache, geoip, key=None):
     if not cache:
         cache = ExclusionCache()
+    key = key or name
     try:
         if any(k in name for k in BAN):
-            if not cache.is_excluded(name):
-                cache.add_excluded(name, '名称或GeoIP过滤')
             return False
-        if server and os.path.exists(GEOIP_DB_PATH):
-            try:
-                ip_address = socket.gethostbyname(server)
-            except (socket.gaierror, ValueError) as e:
-                logging.debug(f"无法解析域名 {server}: {e}")
-                return True
-            try:
-                with GeoIPReader(GEOIP_DB_PATH) as reader:
-                    response = reader.country(ip_address)
-                    if response.country.iso_code == "CN":
-                        if not cache.is_excluded(name):
-                            cache.add_excluded(name, 'GeoIP过滤')
-                        return False
-            except Exception as e:
-                logging.error(f"GeoIP 过滤错误: {e}")
+        if server and geoip.country(server) == "CN":
+            if not cache.is_excluded(key):
+                cache.add_excluded(key, 'GeoIP过滤')
+            return False
         return True
     except Exception as e:
         logging.error(f"GeoIP 过滤或名称检查时出错: {e}")
         return not any(k in name for k in BAN)
 
-class ExclusionCache:
-    def __init__(self, filename="exclusion_cache.json"):
+class SQLiteStore:
+    label = ""
+
+    def __init__(self, filename):
         self.filename = filename
-        self.cache = self.load()
+        self.conn = None
+        self.pending = {}
 
-    def load(self):
+    def open(self, schema, query, params=()):
         try:
-            with open(self.filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
+            self.conn = sqlite3.connect(self.filename)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            for statement in schema:
+                self.conn.execute(statement)
+            return self.conn.execute(query, params).fetchall()
+        except sqlite3.Error as e:
+            logging.error(f"加载{self.label}失败: {e}")
+            self.close()
+            return []
+
+    def write_pending(self, upsert, rows, prune, params=()):
+        if not self.conn:
+            return
+        try:
+            with self.conn:
+                self.conn.executemany(upsert, rows)
+                pruned = self.conn.execute(prune, params).rowcount
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            logging.info(f"{self.label}已写入 {len(rows)} 条，清理过期 {pruned} 条")
+            self.pending.clear()
+        except sqlite3.Error as e:
+            logging.error(f"保存{self.label}失败: {e}")
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+class ExclusionCache(SQLiteStore):
+    label = "排除缓存"
+
+    def __init__(self, filename=EXCLUSION_CACHE_FILE):
+        super().__init__(filename)
+        self.cache = dict(self.open(
+            ("CREATE TABLE IF NOT EXISTS exclusions ("
+             "node_id TEXT PRIMARY KEY, reason TEXT, timestamp REAL, expires REAL)",
+             "CREATE INDEX IF NOT EXISTS exclusions_expires ON exclusions (expires)"),
+            "SELECT node_id, expires FROM exclusions WHERE expires > ?", (time.time(),)))
 
     def save(self):
-        try:
-            with open(self.filename, 'w', encoding='utf-8') as f:
-                json.dump(self.cache, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logging.error(f"保存排除缓存失败: {e}")
-
-    def add_excluded(self, name, reason="未知原因"):
-        self.cache[name] = {"reason": reason, "timestamp": datetime.now().isoformat()}
-
-    def is_excluded(self, name):
-        if name in self.cache:
-            timestamp_str = self.cache[name].get("timestamp")
-            if timestamp_str:
-                cached_time = datetime.fromisoformat(timestamp_str)
-                # 缓存有效期为7天，可自行调整
-                if (datetime.now() - cached_time).total_seconds() < 7 * 24 * 3600:
-                    return True
-        return False
+        self.write_pending("INSERT OR REPLACE INTO exclusions VALUES (?, ?, ?, ?)",
+                           [(key, *entry) for key, entry in self.pending.items()],
+                           "DELETE FROM exclusions WHERE expires <= ?", (time.time(),))
+
+    def add_excluded(self, key, reason="未知原因"):
+        now = time.time()
+        self.cache[key] = now + EXCLUSION_CACHE_TTL
+        self.pending[key] = (reason, now, now + EXCLUSION_CACHE_TTL)
+
+    def is_excluded(self, key):
+        return self.cache.get(key, 0) > time.time()
+
+class LatencyHistory(SQLiteStore):
+    label = "延迟历史"
+
+    def __init__(self, filename=LATENCY_HISTORY_FILE, max_age=LATENCY_MAX_AGE):
+        super().__init__(filename)
+        self.max_age = max_age
+        rows = self.open(
+            ("CREATE TABLE IF NOT EXISTS latency ("
+             "node_id TEXT, kind TEXT, delays TEXT, tested REAL, last_success REAL, history TEXT, "
+             "PRIMARY KEY (node_id, kind))",),
+            "SELECT node_id, kind, delays, tested, last_success, history FROM latency WHERE tested > ?",
+            (time.time() - LATENCY_HISTORY_TTL,))
+        self.entries = {}
+        for key, kind, delays, tested, last_success, history in rows:
+            try:
+                self.entries[(key, kind)] = (json.loads(delays), tested, last_success, json.loads(history))
+            except (TypeError, ValueError):
+                continue
+
+    def fresh(self, key, kind):
+        entry = self.entries.get((key, kind))
+        if entry is None:
+            return None
+        delays, tested, last_success, _ = entry
+        if last_success is None or last_success < tested or time.time() - last_success > self.max_age:
+            return None
+        return delays
+
+    def instability(self, key, kind):
+        entry = self.entries.get((key, kind))
+        if entry is None:
+            return float('inf')
+        history = entry[3]
+        successes = [d for d in history if d is not None]
+        failure_rate = 1 - len(successes) / len(history) if history else 1
+        spread = statistics.pstdev(successes) / statistics.mean(successes) if len(successes) > 1 else 0
+        return failure_rate + spread
+
+    def record(self, key, kind, result):
+        if key is None:
+            return
+        now = time.time()
+        old = self.entries.get((key, kind))
+        history = (old[3] if old else []) + [result.average_delay if result.is_valid else None]
+        history = history[-LATENCY_HISTORY_RUNS:]
+        last_success = now if result.is_valid else (old[2] if old else None)
+        self.entries[(key, kind)] = (result.delays, now, last_success, history)
+        self.pending[(key, kind)] = (json.dumps(result.delays), now, last_success, json.dumps(history))
+
+    def save(self):
+        self.write_pending("INSERT OR REPLACE INTO latency VALUES (?, ?, ?, ?, ?, ?)",
+                           [(*key, *row) for key, row in self.pending.items()],
+                           "DELETE FROM latency WHERE tested <= ?", (time.time() - LATENCY_HISTORY_TTL,))
 
 class ClashAPIException(Exception):
     pass
@@ -614,6 +1195,154 @@ class ProxyTestResult:
     def is_valid(self) -> bool:
         return self.success_rate >= MIN_SUCCESS_RATE and self.std_dev <= MAX_STD_DEV and self.average_delay != float('inf')
 
+class SpeedTestResult:
+    def __init__(self, name: str, samples: List[float] = None, upload: Optional[float] = None,
+                 latencies: List[float] = None, failed_pings: int = 0):
+        self.name = name
+        self.samples = samples if samples is not None else []
+        self.download = statistics.median(self.samples) if self.samples else 0.0
+        self.peak = max(self.samples, default=0.0)
+        self.upload = upload
+        latencies = latencies if latencies is not None else []
+        pings = len(latencies) + failed_pings
+        self.latency = statistics.mean(latencies) if latencies else None
+        self.jitter = statistics.pstdev(latencies) if latencies else None
+        self.packet_loss = failed_pings / pings * 100 if pings else None
+
+    def to_dict(self) -> Dict[str, Optional[float]]:
+        return {"speed": self.download, "peak": self.peak, "upload": self.upload, "latency": self.latency,
+                "jitter": self.jitter, "packet_loss": self.packet_loss}
+
+    @classmethod
+    def from_dict(cls, name: str, entry: Dict[str, Optional[float]]) -> "SpeedTestResult":
+        result = cls(name)
+        result.download = entry["speed"]
+        result.peak = entry.get("peak", entry["speed"])
+        result.upload = entry.get("upload")
+        result.latency = entry.get("latency")
+        result.jitter = entry.get("jitter")
+        result.packet_loss = entry.get("packet_loss")
+        return result
+
+    def summary(self) -> str:
+        text = f"下载 {self.download:.2f}Mb/s (峰值 {self.peak:.2f}Mb/s)"
+        if self.upload is not None:
+            text += f", 上传 {self.upload:.2f}Mb/s"
+        if self.latency is not None:
+            text += f", 负载延迟 {self.latency:.0f}ms, 抖动 {self.jitter:.0f}ms"
+        if self.packet_loss is not None:
+            text += f", 丢包 {self.packet_loss:.1f}%"
+        return text
+
+def can_still_pass(delays: List[Optional[float]], total: int = STABILITY_TESTS) -> bool:
+    successes = sum(1 for d in delays if d is not None)
+    return (successes + total - len(delays)) / total >= MIN_SUCCESS_RATE
+
+def sampling_verdict(delays: List[Optional[float]], total: int = STABILITY_TESTS) -> Optional[bool]:
+    if not can_still_pass(delays, total):
+        return False
+    remaining = total - len(delays)
+    if remaining <= 0:
+        return ProxyTestResult("", delays).is_valid
+    valid_delays = [d for d in delays if d is not None]
+    if not valid_delays or len(valid_delays) / total < MIN_SUCCESS_RATE or remaining > 3:
+        return None
+    # 方差对每个样本是凸函数，最坏情况必在取值区间端点上，枚举剩余样本的失败/最小/最大组合即可
+    for extra in product((None, 0, TIMEOUT * 1000), repeat=remaining):
+        sample = valid_delays + [d for d in extra if d is not None]
+        if len(sample) > 1 and statistics.stdev(sample) > MAX_STD_DEV:
+            return None
+    return True
+
+def is_borderline(delays: List[Optional[float]]) -> bool:
+    result = ProxyTestResult("", delays)
+    return (result.success_rate >= MIN_SUCCESS_RATE
+            and abs(result.std_dev - MAX_STD_DEV) <= MAX_STD_DEV * BORDERLINE_STD_DEV_MARGIN)
+
+def needs_more_samples(delays: List[Optional[float]]) -> bool:
+    if len(delays) < STABILITY_TESTS:
+        return sampling_verdict(delays) is None
+    return len(delays) < STABILITY_TESTS + ADAPTIVE_EXTRA_TESTS and is_borderline(delays)
+
+def speed_verdict(samples: List[float], drop_below: float, keep_at: Optional[float] = None) -> Optional[bool]:
+    if len(samples) < SPEED_TEST_MIN_SAMPLES:
+        return None
+    mean = statistics.mean(samples)
+    margin = SPEED_TEST_CONFIDENCE_Z * statistics.stdev(samples) / math.sqrt(len(samples))
+    if mean + margin < drop_below:
+        return False
+    if (keep_at is not None and len(samples) * SPEED_TEST_SAMPLE_INTERVAL >= SPEED_TEST_KEEP_WINDOW
+            and mean - margin >= keep_at):
+        return True
+    return None
+
+class SpeedCutoff:
+    def __init__(self, speed_limit, candidates, limit=LIMIT):
+        self.speed_limit = speed_limit
+        self.limit = limit
+        self.keep_all = candidates <= limit
+        self.top = []
+
+    def record(self, speed):
+        if self.keep_all or speed < self.speed_limit:
+            return
+        if len(self.top) < self.limit:
+            heapq.heappush(self.top, speed)
+        else:
+            heapq.heappushpop(self.top, speed)
+
+    def drop_below(self):
+        if not self.keep_all and len(self.top) >= self.limit:
+            return max(self.speed_limit, self.top[0])
+        return self.speed_limit
+
+    def keep_at(self):
+        return self.speed_limit if self.keep_all else None
+
+def build_speed_listeners(proxy_names, base_port=SPEED_TEST_LISTENER_PORT):
+    listeners = []
+    ports = {}
+    for i, name in enumerate(proxy_names):
+        port = base_port + i
+        if port > 65535:
+            logging.warning(f"测速监听端口不足，仅为前 {i} 个节点分配独立端口")
+            break
+        listeners.append({
+            "name": f"speed-{i}",
+            "type": "mixed",
+            "listen": CLASH_API_HOST,
+            "port": port,
+            "udp": False,
+            "proxy": name
+        })
+        ports[name] = port
+    return listeners, ports
+
+async def listening_ports(ports, attempts=3):
+    semaphore = Semaphore(64)
+
+    async def is_open(port):
+        async with semaphore:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(CLASH_API_HOST, port), TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                return False
+            writer.close()
+            return True
+
+    pending = list(ports)
+    bound = set()
+    for attempt in range(attempts):
+        results = await asyncio.gather(*(is_open(port) for port in pending))
+        bound.update(port for port, ok in zip(pending, results) if ok)
+        pending = [port for port, ok in zip(pending, results) if not ok]
+        if not pending:
+            break
+        await asyncio.sleep(0.5)
+    if pending:
+        logging.warning(f"{len(pending)} 个测速端口未能监听，相关节点跳过测速")
+    return bound
+
 def ensure_executable(file_path):
     if platform.system().lower() in ['linux', 'darwin']:
         os.chmod(file_path, 0o755)
@@ -627,21 +1356,131 @@ def handle_clash_error(error_message, config_file_path):
     problem_index = int(proxy_index_match.group(1))
     try:
         with open(config_file_path, 'r', encoding='utf-8') as file:
-            config = json.load(file)
+            config = yaml_load(file)
         problem_proxy_name = config['proxies'][problem_index]['name']
         del config['proxies'][problem_index]
         proxies = config['proxy-groups'][1]["proxies"]
         proxies.remove(problem_proxy_name)
         for group in config["proxy-groups"][1:]:
-            group["proxies"] = proxies
+            group["proxies"] = list(proxies)
         with open(config_file_path, 'w', encoding='utf-8') as file:
-            file.write(json.dumps(config, ensure_ascii=False))
+            if config_file_path.endswith('.json'):
+                file.write(json.dumps(config, ensure_ascii=False))
+            else:
+                yaml_dump(config, file, sort_keys=False)
         logging.info(f'修复配置异常，移除proxy[{problem_index}] {problem_proxy_name} 完毕，耗时{time.time() - start_time:.2f}s\n')
         return True
     except Exception as e:
         logging.error(f"处理配置文件时出错: {str(e)}")
         return False
 
+def validate_proxy(proxy) -> Optional[str]:
+    if not isinstance(proxy, dict):
+        return "节点不是字典"
+    if not proxy.get("name") or not isinstance(proxy.get("name"), str):
+        return "缺少 name"
+    if not proxy.get("type"):
+        return "缺少 type"
+    if not proxy.get("server") or not isinstance(proxy.get("server"), str):
+        return "缺少 server"
+    port = proxy.get("port")
+    if isinstance(port, str) and port.strip().isdigit():
+        port = proxy["port"] = int(port)
+    if not isinstance(port, int) or isinstance(port, bool) or not 0 < port < 65536:
+        return f"端口无效: {port!r}"
+    if proxy["type"] in ("vmess", "vless") and not proxy.get("uuid"):
+        return "uuid 为空"
+    if proxy["type"] == "ss" and not proxy.get("cipher"):
+        return "cipher 为空"
+    return None
+
+def test_config_with_core(clash_binary, base_config, proxies):
+    test_config = {k: v for k, v in base_config.items() if k not in ("proxies", "proxy-groups", "rules", "listeners")}
+    test_config["proxies"] = proxies
+    test_config["rules"] = ["MATCH,DIRECT"]
+    with tempfile.NamedTemporaryFile('w', suffix='.yaml', dir='.', delete=False, encoding='utf-8') as f:
+        yaml_dump(test_config, f, sort_keys=False)
+        test_file = f.name
+    try:
+        result = subprocess.run([f"./{clash_binary}", "-t", "-f", test_file], capture_output=True, text=True,
+                                encoding='utf-8', errors='replace', timeout=VALIDATE_TIMEOUT)
+        return result.returncode == 0, result.stdout + result.stderr
+    finally:
+        os.remove(test_file)
+
+def find_invalid_proxies(test, proxies):
+    invalid = []
+    pending = [proxies]
+    while pending:
+        subset = pending.pop()
+        ok, output = test(subset)
+        if ok:
+            continue
+        index_match = re.search(r'proxy (\d+):', output)
+        if index_match and int(index_match.group(1)) < len(subset):
+            index = int(index_match.group(1))
+            invalid.append(subset[index])
+            rest = subset[:index] + subset[index + 1:]
+            if rest:
+                pending.append(rest)
+        elif len(subset) == 1:
+            invalid.append(subset[0])
+        else:
+            mid = len(subset) // 2
+            pending.extend([subset[mid:], subset[:mid]])
+    return invalid
+
+def validate_config(config_file, clash_binary):
+    start_time = time.time()
+    try:
+        with open(config_file, 'r', encoding='utf-8') as f:
+            config = yaml_load(f)
+    except Exception as e:
+        logging.error(f"读取配置文件 {config_file} 失败: {e}")
+        return False
+    proxies = config.get("proxies") or []
+    invalid_names = set()
+    valid_proxies = []
+    for proxy in proxies:
+        reason = validate_proxy(proxy)
+        if reason:
+            logging.warning(f"移除格式错误的节点 {proxy.get('name') if isinstance(proxy, dict) else proxy}: {reason}")
+            if isinstance(proxy, dict) and proxy.get("name"):
+                invalid_names.add(proxy["name"])
+        else:
+            valid_proxies.append(proxy)
+    removed = len(proxies) - len(valid_proxies)
+    bad_proxies = []
+    checked = False
+    try:
+        ok, output = test_config_with_core(clash_binary, config, [])
+        if ok:
+            bad_proxies = find_invalid_proxies(lambda subset: test_config_with_core(clash_binary, config, subset),
+                                               valid_proxies)
+            checked = True
+        else:
+            logging.error(f"不含节点的基础配置未通过 Clash 核心校验，跳过节点校验: {output.strip()[-500:]}")
+    except (subprocess.TimeoutExpired, OSError) as e:
+        logging.error(f"Clash 核心校验无法完成，跳过节点校验: {e}")
+    for proxy in bad_proxies:
+        logging.warning(f"移除 Clash 核心无法加载的节点: {proxy['name']}")
+        invalid_names.add(proxy["name"])
+    if not removed and not bad_proxies:
+        if checked:
+            logging.info(f"配置校验通过，耗时{time.time() - start_time:.2f}s")
+        return checked
+    bad_ids = {id(proxy) for proxy in bad_proxies}
+    config["proxies"] = [proxy for proxy in valid_proxies if id(proxy) not in bad_ids]
+    for group in config.get("proxy-groups", [])[1:]:
+        group["proxies"] = [name for name in group.get("proxies", []) if name not in invalid_names]
+    if config_file.endswith('.json'):
+        with open(config_file, 'w', encoding='utf-8') as f:
+            json.dump(config, f, ensure_ascii=False)
+    else:
+        write_config(config, config_file)
+    logging.info(f"配置校验完成，移除 {removed + len(bad_proxies)} 个无效节点，耗时{time.time() - start_time:.2f}s")
+    return True
+
 def download_and_extract_latest_release():
     url = "https://api.github.com/repos/MetaCubeX/mihomo/releases/latest"
     try:
@@ -704,10 +1543,104 @@ def download_and_extract_latest_release():
         except Exception as e:
             logging.error(f"文件处理失败: {e}")
 
+class ClashProcess:
+    def __init__(self, clash_binary, config_file, api_ports=CLASH_API_PORTS, pid_file=CLASH_PID_FILE):
+        self.cmd = [f"./{clash_binary}", "-f", config_file]
+        self.api_ports = api_ports
+        self.pid_file = pid_file
+        self.process = None
+        self.output = deque(maxlen=200)
+
+    def kill_stale(self):
+        try:
+            with open(self.pid_file, 'r', encoding='utf-8') as f:
+                pid, created = f.read().split()
+            pid, created = int(pid), float(created)
+        except (FileNotFoundError, ValueError):
+            return
+        try:
+            proc = psutil.Process(pid)
+            if abs(proc.create_time() - created) < 1:
+                proc.kill()
+                proc.wait(timeout=5)
+                logging.info(f"已结束上次运行遗留的 Clash 进程 {pid}")
+        except (psutil.NoSuchProcess, psutil.AccessDenied, psutil.TimeoutExpired):
+            pass
+        self._remove_pid_file()
+
+    def _remove_pid_file(self):
+        try:
+            os.remove(self.pid_file)
+        except FileNotFoundError:
+            pass
+
+    def _drain(self, pipe):
+        for line in pipe:
+            line = line.rstrip()
+            self.output.append(line)
+            logging.debug(f"[clash] {line}")
+        pipe.close()
+
+    def start(self):
+        self.kill_stale()
+        self.output.clear()
+        self.process = subprocess.Popen(
+            self.cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            errors='replace'
+        )
+        try:
+            created = psutil.Process(self.process.pid).create_time()
+        except psutil.NoSuchProcess:
+            created = 0
+        with open(self.pid_file, 'w', encoding='utf-8') as f:
+            f.write(f"{self.process.pid} {created}")
+        for pipe in (self.process.stdout, self.process.stderr):
+            threading.Thread(target=self._drain, args=(pipe,), daemon=True).start()
+        return self.wait_ready()
+
+    def wait_ready(self, timeout=CLASH_READY_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        delay = 0.05
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                time.sleep(0.1)
+                return False
+            for port in self.api_ports:
+                try:
+                    response = controller_session.get(f"http://{CLASH_API_HOST}:{port}/version", timeout=1)
+                    if response.status_code == 200:
+                        logging.info(f"Clash API 在端口 {port} 上运行正常")
+                        return True
+                except requests.RequestException:
+                    pass
+            time.sleep(delay)
+            delay = min(delay * 2, 1)
+        logging.error(f"Clash API 在 {timeout}s 内未就绪")
+        return False
+
+    def output_text(self):
+        return "\n".join(self.output)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                pass
+        self._remove_pid_file()
+
+def clash_binary_name():
+    os_type = platform.system().lower()
+    return f"clash-{os_type}" if os_type != "windows" else "clash.exe"
+
 def start_clash():
     download_and_extract_latest_release()
-    os_type = platform.system().lower()
-    clash_binary = f"clash-{os_type}" if os_type != "windows" else "clash.exe"
+    clash_binary = clash_binary_name()
     if not os.path.exists(clash_binary):
         logging.error(f"未找到 Clash 可执行文件: {clash_binary}")
         sys.exit(1)
@@ -718,53 +1651,20 @@ def start_clash():
     if not os.path.exists(config_file):
         logging.error(f"未找到配置文件: {config_file}")
         sys.exit(1)
-    for proc in psutil.process_iter(['name']):
-        if proc.info['name'].startswith('clash'):
-            try:
-                proc.kill()
-                time.sleep(1)
-            except (psutil.NoSuchProcess, psutil.AccessDenied):
-                pass
-    cmd = [f"./{clash_binary}", "-f", config_file]
-    process = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        encoding='utf-8'
-    )
-    time.sleep(2)
-    if process.poll() is not None:
-        stdout, stderr = process.communicate()
-        if "Fatal error" in stderr:
-            if handle_clash_error(stderr, config_file):
-                process = subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    encoding='utf-8'
-                )
-                time.sleep(2)
-                if process.poll() is not None:
-                    stdout, stderr = process.communicate()
-                    logging.error(f"Clash 启动失败: {stderr}")
-                    sys.exit(1)
-            else:
-                logging.error(f"Clash 启动失败: {stderr}")
-                sys.exit(1)
-    for port in CLASH_API_PORTS:
-        try:
-            response = requests.get(f"http://{CLASH_API_HOST}:{port}/version", timeout=2)
-            if response.status_code == 200:
-                logging.info(f"Clash API 在端口 {port} 上运行正常")
-                break
-        except requests.RequestException:
-            logging.warning(f"Clash API 端口 {port} 不可达")
-            if port == CLASH_API_PORTS[-1]:
-                logging.error("所有 Clash API 端口均不可达，启动失败")
-                sys.exit(1)
-    return process
+    if VALIDATE_CONFIG:
+        validate_config(config_file, clash_binary)
+    clash = ClashProcess(clash_binary, config_file)
+    if clash.start():
+        return clash
+    clash.stop()
+    output = clash.output_text()
+    if "Fatal error" in output and handle_clash_error(output, config_file):
+        if clash.start():
+            return clash
+        clash.stop()
+        output = clash.output_text()
+    logging.error(f"Clash 启动失败: {output}")
+    sys.exit(1)
 
 def switch_proxy(proxy_name):
     with switch_lock:
@@ -775,7 +1675,7 @@ def switch_proxy(proxy_name):
                     url = f"http://{CLASH_API_HOST}:{port}/proxies/节点选择"
                     headers = {"Authorization": f"Bearer {CLASH_API_SECRET}"} if CLASH_API_SECRET else {}
                     data = {"name": urllib.parse.quote(proxy_name, safe='')}
-                    response = requests.put(url, headers=headers, json=data, timeout=TIMEOUT)
+                    response = controller_session.put(url, headers=headers, json=data, timeout=TIMEOUT)
                     response.raise_for_status()
                     logging.info(f"成功切换到代理节点: {proxy_name}")
                     return True
@@ -789,15 +1689,31 @@ def switch_proxy(proxy_name):
         return False
 
 class ClashAPI:
-    def __init__(self, host: str, ports: List[int], secret: str = ""):
+    def __init__(self, host: str, ports: List[int], secret: str = "", unix_socket: str = CLASH_API_UNIX_SOCKET,
+                 node_ids: Dict[str, str] = None):
         self.host = host
         self.ports = ports
         self.secret = secret
         self.base_url = None
-        self.client = httpx.AsyncClient(verify=False)
+        limits = httpx.Limits(max_connections=MAX_CONCURRENT_TESTS, max_keepalive_connections=MAX_CONCURRENT_TESTS,
+                              keepalive_expiry=CLASH_API_KEEPALIVE)
+        if unix_socket and os.path.exists(unix_socket):
+            transport = httpx.AsyncHTTPTransport(uds=unix_socket, limits=limits)
+            logging.info(f"通过 Unix socket 连接 Clash API: {unix_socket}")
+        else:
+            transport = httpx.AsyncHTTPTransport(limits=limits)
+        self.client = httpx.AsyncClient(verify=False, transport=transport, timeout=TIMEOUT + 5)
         self.semaphore = Semaphore(MAX_CONCURRENT_TESTS)
+        self.speed_semaphore = Semaphore(SPEED_TEST_CONCURRENCY)
         self.headers = {"Authorization": f"Bearer {secret}"} if secret else {}
         self._test_results_cache = {}
+        self.node_ids = node_ids if node_ids is not None else {}
+
+    def node_key(self, proxy_name: str) -> str:
+        return self.node_ids.get(proxy_name, proxy_name)
+
+    def _result_key(self, proxy_name: str, secondary_test: bool) -> str:
+        return f"{self.node_key(proxy_name)}_{'secondary' if secondary_test else 'primary'}"
 
     async def __aenter__(self):
         for port in self.ports:
@@ -828,125 +1744,297 @@ class ClashAPI:
             logging.error(f"请求错误: {e}")
             return False
     
-    async def test_proxy_delay(self, proxy_name: str, secondary_test: bool = False, cache=None) -> ProxyTestResult:
-        if not self.base_url:
-            raise ClashAPIException("未建立与 Clash API 的连接")
-        if cache and cache.is_excluded(proxy_name):
+    async def probe_proxy_delay(self, proxy_name: str, secondary_test: bool = False, cache=None) -> Optional[float]:
+        async with self.semaphore:
+            try:
+                test_url = SECONDARY_TEST_URL if secondary_test else TEST_URL
+                response = await self.client.get(
+                    f"{self.base_url}/proxies/{urllib.parse.quote(proxy_name, safe='')}/delay",
+                    headers=self.headers,
+                    params={"url": test_url, "timeout": int(TIMEOUT * 1000)}
+                )
+                response.raise_for_status()
+                return response.json().get("delay")
+            except Exception:
+                if cache:
+                    cache.add_excluded(self.node_key(proxy_name), f"{'Secondary' if secondary_test else 'Primary'} 测试失败")
+                return None
+
+    def _cached_result(self, proxy_name: str, secondary_test: bool, cache=None) -> Optional[ProxyTestResult]:
+        if cache and cache.is_excluded(self.node_key(proxy_name)):
             logging.info(f"节点 '{proxy_name}' 在排除缓存中，跳过测试。")
             return ProxyTestResult(proxy_name, delays=[None])
-        cache_key = f"{proxy_name}_{'secondary' if secondary_test else 'primary'}"
-        if cache_key in self._test_results_cache:
-            cached_result = self._test_results_cache[cache_key]
-            if (datetime.now() - cached_result.tested_time).total_seconds() < 60:
-                return cached_result
-        async with self.semaphore:
-            delays = []
-            for _ in range(STABILITY_TESTS):
+        cached_result = self._test_results_cache.get(self._result_key(proxy_name, secondary_test))
+        if cached_result and (datetime.now() - cached_result.tested_time).total_seconds() < 60:
+            return cached_result
+        return None
+
+    async def _test_proxies_in_rounds(self, proxies: List[str], secondary_test: bool = False, cache=None) -> List[ProxyTestResult]:
+        if not self.base_url:
+            raise ClashAPIException("未建立与 Clash API 的连接")
+        results = []
+        delays = {}
+        for proxy_name in proxies:
+            cached_result = self._cached_result(proxy_name, secondary_test, cache)
+            if cached_result:
+                results.append(cached_result)
+            else:
+                delays[proxy_name] = []
+        await self._sample_in_waves(delays, secondary_test, cache)
+        for proxy_name, node_delays in delays.items():
+            result = ProxyTestResult(proxy_name, node_delays)
+            self._test_results_cache[self._result_key(proxy_name, secondary_test)] = result
+            results.append(result)
+        return results
+
+    async def _sample_in_waves(self, delays: Dict[str, List[Optional[float]]], secondary_test: bool = False, cache=None):
+        test_type = "Secondary" if secondary_test else "Primary"
+        last_probe = {}
+
+        async def probe(proxy_name):
+            wait = STABILITY_INTERVAL - (time.monotonic() - last_probe.get(proxy_name, float('-inf')))
+            if wait > 0:
+                await asyncio.sleep(wait)
+            last_probe[proxy_name] = time.monotonic()
+            delays[proxy_name].append(await self.probe_proxy_delay(proxy_name, secondary_test, cache))
+
+        round_index = 0
+        while True:
+            active = [name for name, node_delays in delays.items() if not node_delays or needs_more_samples(node_delays)]
+            if not active:
+                break
+            round_index += 1
+            tasks = [probe(proxy_name) for proxy_name in active]
+            for done, future in enumerate(asyncio.as_completed(tasks), 1):
+                await future
+                print(f"\r{test_type} 第 {round_index} 轮测试进度: {done}/{len(tasks)} "
+                      f"({done / len(tasks) * 100:.1f}%)", end="", flush=True)
+            print()
+
+    async def reload_config(self, config: dict) -> bool:
+        if not self.base_url:
+            raise ClashAPIException("未建立与 Clash API 的连接")
+        try:
+            payload = yaml_dump(config, sort_keys=False)
+            response = await self.client.put(
+                f"{self.base_url}/configs",
+                headers=self.headers,
+                params={"force": "true"},
+                json={"path": "", "payload": payload},
+                timeout=30
+            )
+            response.raise_for_status()
+            return True
+        except httpx.HTTPError as e:
+            logging.error(f"重载 Clash 配置失败: {e}")
+            return False
+
+    async def measure_throughput(self, proxy_url, cutoff=None):
+        received = 0
+        uploaded = 0
+        latencies = []
+        failed_pings = 0
+        measuring = False
+        stop = asyncio.Event()
+
+        async def stream(client):
+            nonlocal received
+            while not stop.is_set():
+                try:
+                    async with client.stream('GET', SPEED_TEST_URL, headers={'Cache-Control': 'no-cache'}) as response:
+                        response.raise_for_status()
+                        async for chunk in response.aiter_bytes():
+                            received += len(chunk)
+                            if stop.is_set():
+                                return
+                except httpx.HTTPError:
+                    await asyncio.sleep(SPEED_TEST_SAMPLE_INTERVAL)
+
+        async def upload_body():
+            nonlocal uploaded
+            chunk = bytes(64 * 1024)
+            remaining = SPEED_TEST_UPLOAD_SIZE
+            while remaining > 0:
+                size = min(len(chunk), remaining)
+                yield chunk[:size]
+                uploaded += size
+                remaining -= size
+
+        async def upload(client):
+            while not stop.is_set():
                 try:
-                    test_url = SECONDARY_TEST_URL if secondary_test else TEST_URL
-                    response = await self.client.get(
-                        f"{self.base_url}/proxies/{urllib.parse.quote(proxy_name, safe='')}/delay",
-                        headers=self.headers,
-                        params={"url": test_url, "timeout": int(TIMEOUT * 1000)}
-                    )
+                    response = await client.post(SPEED_TEST_UPLOAD_URL, content=upload_body(),
+                                                 headers={'Content-Type': 'application/octet-stream',
+                                                          'Content-Length': str(SPEED_TEST_UPLOAD_SIZE)})
                     response.raise_for_status()
-                    delay = response.json().get("delay")
-                    delays.append(delay)
                 except httpx.HTTPError:
-                    delays.append(None)
-                    if cache:
-                        cache.add_excluded(proxy_name, f"{'Secondary' if secondary_test else 'Primary'} 测试失败")
-                except Exception as e:
-                    delays.append(None)
-                    if cache:
-                        cache.add_excluded(proxy_name, f"{'Secondary' if secondary_test else 'Primary'} 测试失败")
-                if _ < STABILITY_TESTS - 1:
-                    await asyncio.sleep(STABILITY_INTERVAL)
-            result = ProxyTestResult(proxy_name, delays)
-            self._test_results_cache[cache_key] = result
-            return result
-    
-    async def test_proxy_speed(self, proxy_name, cache):
-        cache_speed = load_speed_cache()
-        cache_key = proxy_name
-        if cache_key in cache_speed:
-            cached = cache_speed[cache_key]
-            if (datetime.now() - datetime.fromisoformat(cached['timestamp'])).total_seconds() < 24 * 3600:
-                speed = cached['speed']
-                logging.info(f"节点 '{proxy_name}' 速度测试（缓存）: {speed:.2f}Mb/s")
-                results_speed.append((proxy_name, f"{speed:.2f}"))
-                return speed
+                    await asyncio.sleep(SPEED_TEST_SAMPLE_INTERVAL)
 
-        async with self.semaphore:
-            if not await self.async_switch_proxy(proxy_name):
-                cache.add_excluded(proxy_name, "切换失败")
-                logging.warning(f"节点 {proxy_name} 切换失败，跳过速度测试")
-                return 0
-
-            start_time = time.time()
-            total_length = 0
-            test_duration = 10
-            max_retries = 3
-            retry_count = 0
-
-            async with httpx.AsyncClient(proxies={"http://": 'http://127.0.0.1:7890', "https://": 'http://127.0.0.1:7890'}, verify=False) as client:
-                while retry_count < max_retries:
-                    try:
-                        async with client.stream('GET', SPEED_TEST_URL, headers={'Cache-Control': 'no-cache'}, timeout=test_duration) as response:
-                            response.raise_for_status()
-                            async for chunk in response.aiter_bytes():
-                                total_length += len(chunk)
-                                if time.time() - start_time >= test_duration:
-                                    break
-                        break
-                    except (httpx.RequestError, httpx.TimeoutException) as e:
-                        retry_count += 1
-                        logging.warning(f"测试节点 {proxy_name} 下载失败 (重试 {retry_count}/{max_retries}): {e}")
-                        if retry_count == max_retries:
-                            cache.add_excluded(proxy_name, f"测速失败")
-                            logging.error(f"节点 {proxy_name} 测试失败，跳过")
-                            return 0
-                        await asyncio.sleep(1)
-
-            elapsed_time = time.time() - start_time
-            speed = total_length / elapsed_time / 1024 / 1024 if elapsed_time > 0 else 0
-            results_speed.append((proxy_name, f"{speed:.2f}"))
-            cache_speed[cache_key] = {"speed": speed, "timestamp": datetime.now().isoformat()}
-            save_speed_cache(cache_speed)
-            logging.info(f"节点 '{proxy_name}' 速度测试: {speed:.2f}Mb/s")
-            return speed
-
-    async def async_switch_proxy(self, proxy_name):
-        max_retries = 3
-        for attempt in range(max_retries):
-            for port in self.ports:
+        async def ping(client):
+            nonlocal failed_pings
+            while not stop.is_set():
+                start = time.monotonic()
                 try:
-                    url = f"http://{self.host}:{port}/proxies/节点选择"
-                    data = {"name": urllib.parse.quote(proxy_name, safe='')}
-                    async with httpx.AsyncClient(verify=False) as client:
-                        response = await client.put(url, headers=self.headers, json=data, timeout=TIMEOUT)
-                        response.raise_for_status()
-                    logging.info(f"成功切换到代理节点: {proxy_name}")
-                    return True
-                except httpx.RequestError as e:
-                    logging.warning(f"切换代理节点 {proxy_name} 失败 (尝试 {attempt + 1}/{max_retries}): {e}")
-                    if isinstance(e, httpx.HTTPError) and e.response:
-                        logging.warning(f"响应内容: {e.response.text}")
-                    await asyncio.sleep(1)
-        return False
-    
-    async def test_group_proxies(self, proxies: List[str], secondary_test: bool = False, cache=None) -> List[ProxyTestResult]:
+                    response = await client.get(SPEED_TEST_LATENCY_URL, headers={'Cache-Control': 'no-cache'}, timeout=TIMEOUT)
+                    response.raise_for_status()
+                    if measuring:
+                        latencies.append((time.monotonic() - start) * 1000)
+                except httpx.HTTPError:
+                    if measuring:
+                        failed_pings += 1
+                await asyncio.sleep(SPEED_TEST_PING_INTERVAL)
+
+        samples = []
+        upload_rate = None
+        proxies = {"http://": proxy_url, "https://": proxy_url} if proxy_url else None
+        async with httpx.AsyncClient(proxies=proxies, verify=False,
+                                     timeout=SPEED_TEST_WARMUP + SPEED_TEST_DURATION) as client:
+            tasks = [asyncio.create_task(stream(client)) for _ in range(SPEED_TEST_STREAMS)]
+            tasks.append(asyncio.create_task(ping(client)))
+            if SPEED_TEST_UPLOAD:
+                tasks.append(asyncio.create_task(upload(client)))
+            try:
+                await asyncio.sleep(SPEED_TEST_WARMUP)
+                measuring = True
+                last_bytes, last_time = received, time.monotonic()
+                start_uploaded, start_time = uploaded, last_time
+                deadline = last_time + SPEED_TEST_DURATION
+                while last_time < deadline:
+                    await asyncio.sleep(SPEED_TEST_SAMPLE_INTERVAL)
+                    now = time.monotonic()
+                    samples.append((received - last_bytes) / (now - last_time) / 1024 / 1024)
+                    last_bytes, last_time = received, now
+                    if cutoff and speed_verdict(samples, cutoff.drop_below(), cutoff.keep_at()) is not None:
+                        break
+                if SPEED_TEST_UPLOAD:
+                    upload_rate = (uploaded - start_uploaded) / (last_time - start_time) / 1024 / 1024
+            finally:
+                stop.set()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+        return samples, upload_rate, latencies, failed_pings
+
+    async def test_proxy_speed(self, proxy_name, cache, port=None, speed_cache=None, cutoff=None):
+        entry = speed_cache.get(self.node_key(proxy_name)) if speed_cache else None
+        if entry is not None:
+            result = SpeedTestResult.from_dict(proxy_name, entry)
+            logging.info(f"节点 '{proxy_name}' 速度测试（缓存）: {result.summary()}")
+            results_speed.append((proxy_name, f"{result.download:.2f}"))
+            if cutoff:
+                cutoff.record(result.download)
+            return result
+
+        async with self.speed_semaphore:
+            if SPEED_TEST_DIRECT:
+                proxy_url = None
+            elif port:
+                proxy_url = f"http://{CLASH_API_HOST}:{port}"
+            else:
+                logging.warning(f"节点 {proxy_name} 没有可用的测速端口，跳过速度测试")
+                return None
+
+            result = SpeedTestResult(proxy_name, *await self.measure_throughput(proxy_url, cutoff))
+            if not any(result.samples):
+                cache.add_excluded(self.node_key(proxy_name), f"测速失败")
+                logging.error(f"节点 {proxy_name} 测试失败，跳过")
+                return None
+            results_speed.append((proxy_name, f"{result.download:.2f}"))
+            if cutoff:
+                cutoff.record(result.download)
+            if speed_cache:
+                speed_cache.record(self.node_key(proxy_name), result.to_dict())
+            logging.info(f"节点 '{proxy_name}' 速度测试: {result.summary()}")
+            return result
+
+    async def test_group_delay(self, group_name: str, secondary_test: bool = False) -> Optional[Dict[str, int]]:
+        test_url = SECONDARY_TEST_URL if secondary_test else TEST_URL
+        try:
+            response = await self.client.get(
+                f"{self.base_url}/group/{urllib.parse.quote(group_name, safe='')}/delay",
+                headers=self.headers,
+                params={"url": test_url, "timeout": int(TIMEOUT * 1000)},
+                timeout=TIMEOUT + 5
+            )
+            if response.status_code == 504:
+                return {}
+            response.raise_for_status()
+            return {name: delay for name, delay in response.json().items() if delay}
+        except (httpx.HTTPError, ValueError) as e:
+            logging.warning(f"策略组 {group_name} 批量延迟测试失败: {e}")
+            return None
+
+    async def _test_group_proxies_bulk(self, proxies: List[str], secondary_test: bool, cache, base_config: dict):
+        test_type = "Secondary" if secondary_test else "Primary"
+        chunks = {f"{DELAY_GROUP_PREFIX}-{i // DELAY_GROUP_CHUNK}": proxies[i:i + DELAY_GROUP_CHUNK]
+                  for i in range(0, len(proxies), DELAY_GROUP_CHUNK)}
+        test_groups = [{"name": name, "type": "select", "proxies": chunk} for name, chunk in chunks.items()]
+        config = dict(base_config, **{"proxy-groups": base_config.get("proxy-groups", []) + test_groups})
+        if not await self.reload_config(config):
+            return None, proxies
+
+        delays = {name: [] for name in proxies}
+        failed_groups = set()
+        group_semaphore = Semaphore(max(1, MAX_CONCURRENT_TESTS // DELAY_GROUP_CHUNK))
+
+        async def run_chunk(group_name):
+            async with group_semaphore:
+                return group_name, await self.test_group_delay(group_name, secondary_test)
+
+        for round_index in range(STABILITY_TESTS):
+            undecided = {group_name: [name for name in chunk if not delays[name] or needs_more_samples(delays[name])]
+                         for group_name, chunk in chunks.items() if group_name not in failed_groups}
+            active_groups = [name for name, members in undecided.items() if members]
+            if not active_groups:
+                break
+            for group_name, delay_map in await asyncio.gather(*(run_chunk(name) for name in active_groups)):
+                if delay_map is None:
+                    failed_groups.add(group_name)
+                    continue
+                for proxy_name in undecided[group_name]:
+                    delay = delay_map.get(proxy_name)
+                    delays[proxy_name].append(delay)
+                    if delay is None and cache:
+                        cache.add_excluded(self.node_key(proxy_name), f"{test_type} 测试失败")
+            done = round_index + 1
+            print(f"\r{test_type} 批量测试轮次: {done}/{STABILITY_TESTS} ({done / STABILITY_TESTS * 100:.1f}%)", end="", flush=True)
+            if round_index < STABILITY_TESTS - 1:
+                await asyncio.sleep(STABILITY_INTERVAL)
+        print()
+
+        fallback = [name for group_name in failed_groups for name in chunks[group_name]]
+        if ADAPTIVE_EXTRA_TESTS:
+            await self._sample_in_waves({name: node_delays for name, node_delays in delays.items()
+                                         if name not in fallback and node_delays}, secondary_test, cache)
+        results = []
+        for group_name, chunk in chunks.items():
+            if group_name in failed_groups:
+                continue
+            for proxy_name in chunk:
+                result = ProxyTestResult(proxy_name, delays[proxy_name])
+                self._test_results_cache[self._result_key(proxy_name, secondary_test)] = result
+                results.append(result)
+        return results, fallback
+
+    async def test_group_proxies(self, proxies: List[str], secondary_test: bool = False, cache=None,
+                                 base_config: dict = None) -> List[ProxyTestResult]:
         test_type = "Secondary" if secondary_test else "Primary"
         logging.info(f"开始{test_type}测试 {len(proxies)} 个节点 (最大并发: {MAX_CONCURRENT_TESTS})")
-        tasks = [self.test_proxy_delay(proxy_name, secondary_test=secondary_test, cache=cache) for proxy_name in proxies]
         results = []
-        for future in asyncio.as_completed(tasks):
-            result = await future
-            results.append(result)
-            done = len(results)
-            total = len(tasks)
-            print(f"\r{test_type} 测试进度: {done}/{total} ({done / total * 100:.1f}%)", end="", flush=True)
-        print()
+        if BULK_DELAY_TEST and base_config:
+            excluded = [name for name in proxies if cache and cache.is_excluded(self.node_key(name))]
+            results.extend(ProxyTestResult(name, delays=[None]) for name in excluded)
+            excluded = set(excluded)
+            bulk_results, proxies = await self._test_group_proxies_bulk(
+                [name for name in proxies if name not in excluded], secondary_test, cache, base_config)
+            if bulk_results is None:
+                logging.warning(f"{test_type} 批量延迟测试不可用，回退到逐节点测试")
+            else:
+                results.extend(bulk_results)
+            if not proxies:
+                return results
+            logging.info(f"{test_type} 逐节点测试 {len(proxies)} 个节点")
+        results.extend(await self._test_proxies_in_rounds(proxies, secondary_test=secondary_test, cache=cache))
         return results
 
 
@@ -959,7 +2047,7 @@ class ClashConfig:
     def _load_config(self) -> dict:
         try:
             with open(self.config_path, 'r', encoding='utf-8') as f:
-                return yaml.safe_load(f)
+                return yaml_load(f)
         except FileNotFoundError:
             logging.error(f"找不到配置文件: {self.config_path}")
             sys.exit(1)
@@ -1022,11 +2110,8 @@ class ClashConfig:
 
     def save(self):
         try:
-            yaml_cfg = self.config_path.strip('.json') if self.config_path.endswith('.json') else self.config_path
-            with open(yaml_cfg, 'w', encoding='utf-8') as f:
-                yaml.dump(self.config, f, allow_unicode=True, sort_keys=False)
-            with open(f'{yaml_cfg}.json', "w", encoding="utf-8") as f:
-                json.dump(self.config, f, ensure_ascii=False)
+            yaml_cfg = self.config_path[:-5] if self.config_path.endswith('.json') else self.config_path
+            write_config(self.config, yaml_cfg, sort_keys=False)
             logging.info("配置文件保存成功")
         except Exception as e:
             logging.error(f"保存配置文件失败: {e}")
@@ -1057,13 +2142,120 @@ def print_test_summary(group_name: str, results: List[ProxyTestResult], test_typ
             logging.info(f"{i}. {result.name}: 平均 {result.average_delay:.2f}ms, 标准差 {result.std_dev:.2f}ms, 成功率 {result.success_rate * 100:.2f}%")
     return delays
 
+SHARD_PORT_KEYS = ("port", "socks-port", "redir-port", "mixed-port")
+
+def build_shard_config(config, proxy_names, index):
+    names = set(proxy_names)
+    all_names = {p.get("name") for p in config.get("proxies", [])}
+    shard = {k: v for k, v in config.items() if k not in ("listeners", "external-controller-unix")}
+    for key in SHARD_PORT_KEYS:
+        if key in config:
+            shard[key] = int(config[key]) + index * CLASH_SHARD_PORT_STEP
+    shard["external-controller"] = f"{CLASH_API_HOST}:{CLASH_API_PORTS[0] + index}"
+    shard["proxies"] = [p for p in config.get("proxies", []) if p.get("name") in names]
+    groups = copy.deepcopy(config.get("proxy-groups", []))
+    for group in groups[1:]:
+        group["proxies"] = [n for n in group.get("proxies", []) if n in names or n not in all_names] or ["DIRECT"]
+    shard["proxy-groups"] = groups
+    return shard
+
+class ClashShard:
+    def __init__(self, index, config, clash_binary, node_ids):
+        self.index = index
+        self.config = config
+        self.port = CLASH_API_PORTS[0] + index
+        root, ext = os.path.splitext(CONFIG_FILE[:-5] if CONFIG_FILE.endswith('.json') else CONFIG_FILE)
+        self.config_file = f"{root}.shard{index}{ext}"
+        self.process = ClashProcess(clash_binary, self.config_file, api_ports=[self.port],
+                                    pid_file=f"clash.shard{index}.pid")
+        self.api = ClashAPI(CLASH_API_HOST, [self.port], CLASH_API_SECRET, unix_socket="", node_ids=node_ids)
+
+    def start(self):
+        with open(self.config_file, "w", encoding="utf-8") as f:
+            yaml_dump(self.config, f, sort_keys=False, default_flow_style=False)
+        if self.process.start():
+            return True
+        logging.warning(f"分片 {self.index} 启动失败: {self.process.output_text()[-500:]}")
+        self.process.stop()
+        return False
+
+    def stop(self):
+        self.process.stop()
+        if os.path.exists(self.config_file):
+            os.remove(self.config_file)
+
 class ClashManager:
     def __init__(self, config_file: str):
         self.config_file = config_file
         self.config = ClashConfig(config_file)
         self.cache = ExclusionCache()
-        self.api = ClashAPI(CLASH_API_HOST, CLASH_API_PORTS, CLASH_API_SECRET)
+        self.node_ids = {p.get("name"): node_id(p) for p in self.config.config.get("proxies", [])}
+        self.api = ClashAPI(CLASH_API_HOST, CLASH_API_PORTS, CLASH_API_SECRET, node_ids=self.node_ids)
+        self.speed_cache = SpeedCache()
         self.executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TESTS)
+        self.shards = []
+        self.shard_of = {}
+        self.history = LatencyHistory()
+
+    async def start_shards(self, proxies):
+        count = min(CLASH_SHARDS, len(proxies))
+        if count <= 1:
+            return
+        clash_binary = clash_binary_name()
+        shards = [ClashShard(i, build_shard_config(self.config.config, proxies[i::count], i), clash_binary, self.node_ids)
+                  for i in range(1, count)]
+        loop = asyncio.get_running_loop()
+        started = await asyncio.gather(*(loop.run_in_executor(self.executor, shard.start) for shard in shards))
+        for shard, ok in zip(shards, started):
+            if ok:
+                await shard.api.__aenter__()
+                self.shards.append(shard)
+                self.shard_of.update((name, shard) for name in proxies[shard.index::count])
+            else:
+                shard.stop()
+                await shard.api.client.aclose()
+        if self.shards:
+            logging.info(f"已启动 {len(self.shards)} 个额外 Clash 分片，节点按 {len(self.shards) + 1} 个实例并行测试")
+        else:
+            logging.warning("额外 Clash 分片均未能启动，所有节点在主实例上测试")
+
+    async def stop_shards(self):
+        for shard in self.shards:
+            await shard.api.__aexit__(None, None, None)
+            shard.stop()
+        self.shards = []
+        self.shard_of = {}
+
+    async def test_proxies(self, proxies, secondary_test=False):
+        kind = "secondary" if secondary_test else "primary"
+        reused = []
+        pending = []
+        for name in proxies:
+            delays = self.history.fresh(self.node_ids.get(name), kind)
+            if delays is None:
+                pending.append(name)
+            else:
+                reused.append(ProxyTestResult(name, delays))
+        if reused:
+            logging.info(f"复用 {len(reused)} 个节点的 {kind} 历史延迟结果，需重新测试 {len(pending)} 个节点")
+        pending.sort(key=lambda name: self.history.instability(self.node_ids.get(name), kind), reverse=True)
+        results = await self._test_proxies_on_shards(pending, secondary_test)
+        for result in results:
+            self.history.record(self.node_ids.get(result.name), kind, result)
+        return reused + results
+
+    async def _test_proxies_on_shards(self, proxies, secondary_test=False):
+        if not proxies:
+            return []
+        if CLASH_SHARDS > 1 and not self.shards:
+            await self.start_shards(proxies)
+        parts = [(self.api, self.config.config, [name for name in proxies if name not in self.shard_of])]
+        parts.extend((shard.api, shard.config, [name for name in proxies if self.shard_of.get(name) is shard])
+                     for shard in self.shards)
+        results = await asyncio.gather(*(api.test_group_proxies(names, secondary_test=secondary_test, cache=self.cache,
+                                                                base_config=base_config)
+                                         for api, base_config, names in parts if names))
+        return [result for shard_results in results for result in shard_results]
 
     async def run_tests(self):
         logging.info("===================节点批量检测基本信息======================")
@@ -1097,17 +2289,21 @@ class ClashManager:
                     logging.warning(f"策略组 '{group_name}' 中没有代理节点")
                     return
                 
-                primary_results = await clash_api.test_group_proxies(proxies, secondary_test=False, cache=self.cache)
-                all_test_results.extend(primary_results)
-                print_test_summary(group_name, primary_results, test_type="Primary")
-                
-                valid_proxies = [r.name for r in primary_results if r.is_valid]
-                if not valid_proxies:
-                    logging.warning("没有节点通过 Primary 测试，停止后续测试")
-                    return
-                
-                logging.info(f"\n======================== 开始 Secondary 测试策略组: {group_name} ====================")
-                secondary_results = await clash_api.test_group_proxies(valid_proxies, secondary_test=True, cache=self.cache)
+                try:
+                    primary_results = await self.test_proxies(proxies, secondary_test=False)
+                    all_test_results.extend(primary_results)
+                    print_test_summary(group_name, primary_results, test_type="Primary")
+
+                    valid_proxies = [r.name for r in primary_results if r.is_valid]
+                    if not valid_proxies:
+                        logging.warning("没有节点通过 Primary 测试，停止后续测试")
+                        return
+
+                    logging.info(f"\n======================== 开始 Secondary 测试策略组: {group_name} ====================")
+                    secondary_results = await self.test_proxies(valid_proxies, secondary_test=True)
+                finally:
+                    await self.stop_shards()
+                    self.history.save()
                 all_test_results.extend(secondary_results)
                 print_test_summary(group_name, secondary_results, test_type="Secondary")
                 
@@ -1132,7 +2328,7 @@ class ClashManager:
                 
                 if SPEED_TEST:
                     logging.info('\n===================检测节点速度======================\n')
-                    name_mapping = await self.api.start_download_test(proxy_names, speed_limit=0.1)
+                    name_mapping = await self.start_download_test(proxy_names, speed_limit=0.1)
                     self.config.update_proxies_names(name_mapping)
                     
                 self.config.save()
@@ -1145,15 +2341,43 @@ class ClashManager:
         except Exception as e:
             logging.error(f"发生错误: {e}")
             raise
+        finally:
+            self.history.close()
+            self.cache.close()
     
+    async def open_speed_listeners(self, proxy_names):
+        listeners, ports = build_speed_listeners(proxy_names)
+        config = dict(self.config.config, listeners=listeners)
+        if not await self.api.reload_config(config):
+            logging.warning("创建独立测速端口失败，跳过测速")
+            return {}
+        bound = await listening_ports(ports.values())
+        ports = {name: port for name, port in ports.items() if port in bound}
+        logging.info(f"已为 {len(ports)} 个节点创建独立测速端口")
+        return ports
+
     async def start_download_test(self, proxy_names, speed_limit=0.1):
-        test_proxies = [name for name in proxy_names if not self.cache.is_excluded(name)][:SPEED_TEST_LIMIT]
+        test_proxies = [name for name in proxy_names if not self.cache.is_excluded(self.api.node_key(name))][:SPEED_TEST_LIMIT]
         if not test_proxies:
             logging.warning("所有节点都在排除缓存中，跳过测速。")
             return {}
 
-        tasks = [self.api.test_proxy_speed(name, self.cache) for name in test_proxies]
-        await asyncio.gather(*tasks)
+        ports = {}
+        if not SPEED_TEST_DIRECT:
+            ports = await self.open_speed_listeners(test_proxies)
+            test_proxies = [name for name in test_proxies if name in ports]
+            if not test_proxies:
+                logging.warning("没有可用的测速端口，跳过测速。")
+                return {}
+        cutoff = SpeedCutoff(speed_limit, len(test_proxies))
+        tasks = [self.api.test_proxy_speed(name, self.cache, port=ports.get(name), speed_cache=self.speed_cache,
+                                           cutoff=cutoff)
+                 for name in test_proxies]
+        self.speed_cache.start()
+        try:
+            details = {result.name: result for result in await asyncio.gather(*tasks) if result}
+        finally:
+            await self.speed_cache.close()
 
         filtered_list = [(name, float(speed)) for name, speed in results_speed if float(speed) >= float(f'{speed_limit}')]
         
@@ -1166,7 +2390,8 @@ class ClashManager:
             new_name = f"{base_name}_{speed:.2f}Mb/s"
             sorted_proxy_names.append(new_name)
             name_mapping[proxy_name] = new_name
-            logging.info(f"{i}. {new_name}: {speed:.2f}Mb/s")
+            detail = details.get(proxy_name)
+            logging.info(f"{i}. {new_name}: {detail.summary() if detail else f'{speed:.2f}Mb/s'}")
         
         added_elements = set(name_mapping.values())
         for item in proxy_names:
@@ -1255,8 +2480,7 @@ def parse_template(template_url, datetime_vars):
         return result
     return re.sub(r'\{([^}]+)\}', replace_template, template_url)
 
-def load_speed_cache():
-    cache_file = "speed_cache.json"
+def load_speed_cache(cache_file=SPEED_CACHE_FILE):
     cache = {}
     if os.path.exists(cache_file):
         try:
@@ -1267,14 +2491,69 @@ def load_speed_cache():
             pass
     return cache
 
-def save_speed_cache(cache):
-    cache_file = "speed_cache.json"
+def save_speed_cache(cache, cache_file=SPEED_CACHE_FILE):
+    tmp_file = f"{cache_file}.tmp"
     try:
-        with open(cache_file, 'w', encoding='utf-8') as f:
-            json.dump(cache, f, ensure_ascii=False, indent=2)
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp_file, cache_file)
     except Exception as e:
         logging.error(f"保存速度缓存失败: {e}")
 
+class SpeedCache:
+    def __init__(self, filename=SPEED_CACHE_FILE, ttl=SPEED_CACHE_TTL):
+        self.filename = filename
+        self.cache = {}
+        self.dirty = False
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self._writing = None
+        now = time.time()
+        for key, entry in load_speed_cache(filename).items():
+            try:
+                if now - datetime.fromisoformat(entry["timestamp"]).timestamp() < ttl:
+                    self.cache[key] = entry
+            except (KeyError, TypeError, ValueError):
+                continue
+
+    def get(self, key):
+        entry = self.cache.get(key)
+        return entry if entry and "speed" in entry else None
+
+    def record(self, key, metrics):
+        self.cache[key] = dict(metrics, timestamp=datetime.now().isoformat())
+        self.dirty = True
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            snapshot = dict(self.cache)
+            self._writing = asyncio.get_running_loop().run_in_executor(None, save_speed_cache, snapshot, self.filename)
+            await asyncio.shield(self._writing)
+
+    async def _flush_periodically(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await self.flush()
+
+    def start(self, interval=SPEED_CACHE_FLUSH_INTERVAL):
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_periodically(interval))
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        if self._writing is not None:
+            await self._writing
+        await self.flush()
+
 def upload_and_generate_urls(file_path=CONFIG_FILE):
     result = {"clash_url": None, "singbox_url": None}
     try:
@@ -1309,8 +2588,7 @@ def work(links, check=False, allowed_types=[], only_check=False):
             if allowed_types:
                 load_nodes = filter_by_types_alt(allowed_types, nodes=load_nodes)
             links = merge_lists(read_txt_files(folder_path=INPUT), links)
-            if links or load_nodes:
-                asyncio.run(generate_clash_config(links, load_nodes))
+            asyncio.run(generate_clash_config(links, load_nodes))
         if check or only_check:
             clash_process = None
             try:
@@ -1331,7 +2609,7 @@ def work(links, check=False, allowed_types=[], only_check=False):
             finally:
                 logging.info(f'关闭Clash API')
                 if clash_process is not None:
-                    clash_process.kill()
+                    clash_process.stop()
     except KeyboardInterrupt:
         logging.info("\n用户中断执行")
         sys.exit(0)
@@ -1340,6 +2618,10 @@ def work(links, check=False, allowed_types=[], only_check=False):
         sys.exit(1)
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--bench':
+        benchmark_link_parsers(*sys.argv[2:3])
+        benchmark_yaml()
+        sys.exit(0)
     links = [
         "https://raw.githubusercontent.com/qjlxg/vt/refs/heads/main/link_cleaned.yaml"
     ]